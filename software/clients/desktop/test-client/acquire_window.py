@@ -23,6 +23,8 @@
 import base64
 import math
 import json
+import threading
+import concurrent.futures
 
 import gi
 gi.require_version('Gtk', '3.0')
@@ -43,6 +45,9 @@ import dip
 
 from model import LocalDBModel
 
+# Foreground/background brush thickness, in image pixels
+BRUSH_SIZE = 2
+
 
 class AcquireWindow(object):
 
@@ -50,6 +55,13 @@ class AcquireWindow(object):
         self.application = application
         self.vars = vars
         self.eye_side = 'R'
+        # GrabCut runs here, off the GTK main loop (OpenCV releases the GIL)
+        self.segment_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.segment_generation = 0
+        self.segment_cancel = None
+        # on_done of the running segmentation, tells a rect job from a mask one
+        self.segment_on_done = None
+        self.paint_tick = None
         self._reset_image_actions()
         try:
             self.builder = Gtk.Builder.new_from_file('acquire_window.glade')
@@ -65,9 +77,58 @@ class AcquireWindow(object):
         self.acquire_window.show_all()
 
     def close(self, *args):
+        self._cancel_segmentation()
+        self.segment_executor.shutdown(wait=False)
         self.acquire_window.destroy()
 
+    def _cancel_segmentation(self):
+        # Whatever is running is now stale: stop it at the next iteration
+        # and make sure its result is ignored
+        self.segment_generation += 1
+        if self.segment_cancel is not None:
+            self.segment_cancel.set()
+            self.segment_cancel = None
+        self.segment_on_done = None
+
+    def _start_segmentation(self, job, on_done):
+        # job(progress, cancel) runs on the executor, on_done(result) on the
+        # GTK main loop, unless a newer request superseded it
+        self._cancel_segmentation()
+        generation = self.segment_generation
+        cancel = threading.Event()
+        self.segment_cancel = cancel
+        self.segment_on_done = on_done
+        def progress(done, total):
+            GLib.idle_add(self._on_segmentation_progress, generation, done / total)
+        future = self.segment_executor.submit(job, progress, cancel)
+        future.add_done_callback(
+            lambda f: GLib.idle_add(self._on_segmentation_done, generation, f, on_done)
+        )
+        self._on_segmentation_progress(generation, 0.0)
+
+    def _on_segmentation_progress(self, generation, fraction):
+        if generation == self.segment_generation:
+            self.builder.get_object('pb_segmentation').set_fraction(fraction)
+        return False
+
+    def _on_segmentation_done(self, generation, future, on_done):
+        if generation != self.segment_generation:
+            # Superseded by a newer request
+            return False
+        self.segment_cancel = None
+        self.segment_on_done = None
+        try:
+            result = future.result()
+        except dip.GrabCutCancelled:
+            return False
+        except Exception as e:
+            print('AcquireWindow:: Segmentation error:', e)
+            return False
+        on_done(result)
+        return False
+
     def _reset_image_actions(self):
+        self._cancel_segmentation()
         self.im_filtered = None
         self.gb_mask = None
         self.gb_fg_model = None
@@ -81,13 +142,16 @@ class AcquireWindow(object):
         self.rect_x2 = 0
         self.rect_y2 = 0
         self.gb_final_mask = None
+        self.im_rect = None
+        # Brush strokes: last stroke point, persistent work_img pixbuf and the
+        # region of it still to be repainted
+        self.last_point = None
+        self.work_pixbuf = None
+        self.dirty_rect = None
 
     def _change_eye(self):
-        if self.eye_side == 'R':
-            self.im_filtered = dip.right_eye(self.vars.sample_img_bgr)
-        else:
-            self.im_filtered = dip.left_eye(self.vars.sample_img_bgr)
-        self.im_filtered = cv2.bilateralFilter(self.im_filtered, 9, 75, 75)
+        # Filtered once per sample, shared: never changed in place here
+        self.im_filtered = self.vars.preprocessor.get(self.vars.sample_key, self.vars.sample_img_bgr, self.eye_side)
         dip.show_img(self.builder.get_object('work_img'), self.im_filtered)
         self._label_eye_side()
 
@@ -105,31 +169,66 @@ class AcquireWindow(object):
         return 0
 
     def _draw_fg_bg_pixel(self, x, y):
-        bgr = [255, 255, 255]
+        bgr = (255, 255, 255)
         mask_point = 1
         if self.drawing_type == 2:
-            bgr = [0, 0, 0]
+            bgr = (0, 0, 0)
             mask_point = 0
-        x1a, x1b = x, x
-        y1a, y1b = y, y
-        if x > 1:
-            x1a -= 1
-        if x < (self.gb_im_mask.shape[1]-1):
-            x1b += 1
-        if y > 1:
-            y1a -= 1
-        if y < (self.gb_im_mask.shape[0]-1):
-            y1b += 1
-        self.gb_im_mask[y1a:y1b, x1a:x1b] = bgr
-        self.gb_mask_aux[y1a:y1b, x1a:x1b] = mask_point
-        dip.show_img(self.builder.get_object('work_img'), self.gb_im_mask)
+        # Joined to the previous motion event, so fast strokes leave no gaps
+        x0, y0 = (x, y) if self.last_point is None else self.last_point
+        self.last_point = (x, y)
+        cv2.line(self.gb_im_mask, (x0, y0), (x, y), bgr, BRUSH_SIZE)
+        cv2.line(self.gb_mask_aux, (x0, y0), (x, y), mask_point, BRUSH_SIZE)
+        self._mark_dirty(
+            min(x0, x) - BRUSH_SIZE,
+            min(y0, y) - BRUSH_SIZE,
+            max(x0, x) + BRUSH_SIZE + 1,
+            max(y0, y) + BRUSH_SIZE + 1
+        )
+
+    def _mark_dirty(self, x1, y1, x2, y2):
+        height, width = self.gb_im_mask.shape[:2]
+        x1, y1 = max(x1, 0), max(y1, 0)
+        x2, y2 = min(x2, width), min(y2, height)
+        if x1 >= x2 or y1 >= y2:
+            return
+        if self.dirty_rect is not None:
+            dx1, dy1, dx2, dy2 = self.dirty_rect
+            x1, y1, x2, y2 = min(x1, dx1), min(y1, dy1), max(x2, dx2), max(y2, dy2)
+        self.dirty_rect = (x1, y1, x2, y2)
+        if self.paint_tick is None:
+            self.paint_tick = self.builder.get_object('work_img').add_tick_callback(self._on_work_img_tick)
+
+    def _on_work_img_tick(self, widget, frame_clock):
+        # Once per frame, however many motion events came in
+        self.paint_tick = None
+        dirty_rect, self.dirty_rect = self.dirty_rect, None
+        if dirty_rect is None or self.gb_im_mask is None:
+            return GLib.SOURCE_REMOVE
+        if self.work_pixbuf is None:
+            self.work_pixbuf = dip.cv_to_pixbuf(self.gb_im_mask)
+        else:
+            x1, y1, x2, y2 = dirty_rect
+            dip.paste_to_pixbuf(self.work_pixbuf, self.gb_im_mask[y1:y2, x1:x2], x1, y1)
+        widget.set_from_pixbuf(self.work_pixbuf)
+        return GLib.SOURCE_REMOVE
 
     def _on_work_img_button_press(self, widget, event):
         if event.type == Gdk.EventType.BUTTON_PRESS:
             if event.button == 1:
+                if self.drawing_type == 0:
+                    # A new rectangle makes any running segmentation stale
+                    self._cancel_segmentation()
+                elif self.gb_mask is None or self.segment_on_done == self._on_rect_segmented:
+                    # Strokes refine the rectangle result: none to start from yet
+                    return True
+                elif self.segment_on_done == self._on_mask_segmented:
+                    # The stroke changes the mask being refined
+                    self._cancel_segmentation()
                 self.start_drawing = True
                 self.rect_x1 = math.floor(event.x)
                 self.rect_y1 = math.floor(event.y)
+                self.last_point = None
                 if self.drawing_type in (1, 2) and self.gb_im_mask is None:
                     self.gb_im_mask = self.im_filtered.copy()
                     self.gb_mask_aux = self.gb_mask.copy()
@@ -142,8 +241,13 @@ class AcquireWindow(object):
             y2 = math.floor(event.y)
             if self.drawing_type == 0:
                 if x2 >= self.rect_x1 and y2 >= self.rect_y2:
-                    im_rect = cv2.rectangle(self.im_filtered.copy(), (self.rect_x1, self.rect_y1), (x2, y2), (255, 0, 0), 2)
-                    dip.show_img(self.builder.get_object('work_img'), im_rect)
+                    # One buffer for the whole drag, redrawn in place
+                    if self.im_rect is None:
+                        self.im_rect = np.empty_like(self.im_filtered)
+                    np.copyto(self.im_rect, self.im_filtered)
+                    cv2.rectangle(self.im_rect, (self.rect_x1, self.rect_y1), (x2, y2), (255, 0, 0), 2)
+                    dip.invalidate_img(self.im_rect)
+                    dip.show_img(self.builder.get_object('work_img'), self.im_rect)
             else:
                 self._draw_fg_bg_pixel(x2, y2)
         return True
@@ -151,6 +255,7 @@ class AcquireWindow(object):
     def _on_work_img_button_release(self, widget, event):
         if self.start_drawing:
             self.start_drawing = False
+            self.last_point = None
         self.rect_x2 = math.floor(event.x)
         self.rect_y2 = math.floor(event.y)
         return True
@@ -159,29 +264,46 @@ class AcquireWindow(object):
         self.drawing_type = self._get_drawing_type()
 
     def _on_btapply_click(self, widget):
+        im_filtered = self.im_filtered
         if self.drawing_type == 0:
-            self.gb_mask, self.gb_bg_model, self.gb_fg_model = dip.grab_cut_rect(
-                self.im_filtered,
-                (self.rect_x1, self.rect_y1, self.rect_x2, self.rect_y2)
-            )
-            im_mask = np.where((self.gb_mask==2)|(self.gb_mask==0), 0, 1).astype('uint8')
-            im_masked = self.im_filtered * im_mask[:, :, np.newaxis]
-            dip.show_img(self.builder.get_object('result_img'), im_masked)
+            rect = (self.rect_x1, self.rect_y1, self.rect_x2, self.rect_y2)
+            def job(progress, cancel):
+                return dip.grab_cut_rect(im_filtered, rect, progress=progress, cancel=cancel)
+            self._start_segmentation(job, self._on_rect_segmented)
         if self.drawing_type in (1, 2):
             if self.gb_bg_model is not None and self.gb_fg_model is not None and self.gb_mask_aux is not None:
-                gb_mask, self.gb_bg_model, self.gb_fg_model = dip.grab_cut_mask(
-                    self.im_filtered,
-                    self.gb_mask_aux,
-                    bg_model=self.gb_bg_model,
-                    fg_model=self.gb_fg_model
-                )
-                self.gb_final_mask = np.where((gb_mask==2)|(gb_mask==0), 0, 1).astype('uint8')
-                im_masked = self.im_filtered * self.gb_final_mask[:, :, np.newaxis]
-                # Save masked image
-                fmask = '/'.join([self.vars.app_dir, 'imgs', 'gb_masked.jpg'])
-                print('Saving to ', fmask)
-                cv2.imwrite(fmask, im_masked)
-                dip.show_img(self.builder.get_object('result_img'), im_masked)
+                # The worker gets its own copies, the user may keep painting
+                mask = self.gb_mask_aux.copy()
+                bg_model = self.gb_bg_model.copy()
+                fg_model = self.gb_fg_model.copy()
+                def job(progress, cancel):
+                    return dip.grab_cut_mask(
+                        im_filtered,
+                        mask,
+                        bg_model=bg_model,
+                        fg_model=fg_model,
+                        progress=progress,
+                        cancel=cancel
+                    )
+                self._start_segmentation(job, self._on_mask_segmented)
+
+    def _on_rect_segmented(self, result):
+        self.gb_mask, self.gb_bg_model, self.gb_fg_model = result
+        im_mask = dip.final_mask(self.gb_mask)
+        im_masked = self.im_filtered * im_mask[:, :, np.newaxis]
+        dip.show_img(self.builder.get_object('result_img'), im_masked)
+
+    def _on_mask_segmented(self, result):
+        # Further strokes refine this mask, as when it was segmented in place
+        # (a new stroke cancels a running segmentation, so none is lost here)
+        self.gb_mask_aux, self.gb_bg_model, self.gb_fg_model = result
+        self.gb_final_mask = dip.final_mask(self.gb_mask_aux)
+        im_masked = self.im_filtered * self.gb_final_mask[:, :, np.newaxis]
+        # Save masked image
+        fmask = '/'.join([self.vars.app_dir, 'imgs', 'gb_masked.jpg'])
+        print('Saving to ', fmask)
+        cv2.imwrite(fmask, im_masked)
+        dip.show_img(self.builder.get_object('result_img'), im_masked)
 
     def _on_btreset_work_img(self, widget):
         self._reset_image_actions()
@@ -190,20 +312,18 @@ class AcquireWindow(object):
     def _on_btfeature_click(self, widget):
         # print(self.gb_final_mask)
         if self.gb_final_mask is not None:
-            bgr_mean_vector, br_value, bg_value = dip.calc_yellow(self.gb_final_mask, self.im_filtered)
-            self.builder.get_object('lb_br_value').set_text('{:.2f}'.format(br_value))
-            self.builder.get_object('lb_bg_value').set_text('{:.2f}'.format(bg_value))
+            features = dip.eye_features(self.im_filtered, self.gb_final_mask)
+            if features is None:
+                return
+            self.builder.get_object('lb_br_value').set_text('{:.2f}'.format(features['BR']))
+            self.builder.get_object('lb_bg_value').set_text('{:.2f}'.format(features['BG']))
             # Updating sample
             sample_row = self.vars.db.get_sample(self.vars.last_sample_id)
             # Sample data is 4th col
             sample_data = json.loads(sample_row[3])
             if not ('eyes' in sample_data):
                 sample_data['eyes'] = {}
-            sample_data['eyes'][self.eye_side] = {
-                'BR': float(br_value),
-                'BG': float(bg_value),
-                'BGR': [i for i in map(int, bgr_mean_vector)]
-            }
+            sample_data['eyes'][self.eye_side] = features
             # Convert to JSON
             sample_json = json.dumps(sample_data, ensure_ascii=False)
             self.vars.db.update_sample(self.vars.last_sample_id, sample_json)
@@ -0,0 +1,156 @@
+# MIT License
+
+# Copyright (c) 2021 Anderson R. Livramento
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import argparse
+import concurrent.futures
+import json
+import os
+import re
+import sys
+import time
+
+import cv2
+
+import dip
+
+from model import LocalDBModel
+
+SAMPLE_FILE_RE = re.compile(r'eye-sample-(\d+)\.jpg$')
+
+
+def find_images(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.lower().endswith(('.jpg', '.jpeg')):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+
+def init_worker():
+    # Parallelism comes from the processes, not from OpenCV threads
+    cv2.setNumThreads(1)
+
+
+def analyze_file(fname, margin, ite, levels):
+    ti = time.perf_counter()
+    sample_img_bgr = cv2.imread(fname)
+    if sample_img_bgr is None:
+        raise ValueError('Unable to read {}'.format(fname))
+    eyes = dip.analyze_sample(sample_img_bgr, margin=margin, ite=ite, levels=levels)
+    if None in eyes.values():
+        raise ValueError('Nothing segmented in {}'.format(fname))
+    return (fname, eyes, time.perf_counter() - ti)
+
+
+def save_results(db, fname, eyes):
+    # Results go to the local sample of the remote eye-sample-N.jpg. Eyes
+    # already analyzed by an operator are kept, only empty or previous
+    # batch results are written. Returns the update future, or None when
+    # there is nothing to write.
+    match = SAMPLE_FILE_RE.search(os.path.basename(fname))
+    if not match:
+        return None
+    sample_row = db.get_sample_by_remote_id(int(match.group(1)))
+    if sample_row is None:
+        return None
+    # Sample data is 4th col
+    sample_data = json.loads(sample_row[3])
+    if not ('eyes' in sample_data):
+        sample_data['eyes'] = {}
+    updated = False
+    for side, values in eyes.items():
+        current = sample_data['eyes'].get(side)
+        if current and current.get('source') != 'batch':
+            continue
+        sample_data['eyes'][side] = dict(values, source='batch')
+        updated = True
+    if not updated:
+        return None
+    return db.update_sample(sample_row[0], json.dumps(sample_data, ensure_ascii=False), wait=False)
+
+
+def main(argv=None):
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Computes BR/BG of captured eye images, without the GUI.')
+    parser.add_argument('paths', nargs='*', default=[os.path.join(app_dir, 'imgs')], help='JPEG files or folders')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='worker processes')
+    parser.add_argument('-m', '--margin', type=float, default=0.1, help='GrabCut rectangle inset, as a fraction of the eye ROI')
+    parser.add_argument('-i', '--iterations', type=int, default=5, help='GrabCut iterations')
+    parser.add_argument('-p', '--pyramid', type=int, default=0, help='coarse to fine GrabCut levels (0 = full resolution only)')
+    parser.add_argument('--db', default=app_dir, help='folder of the local samples database')
+    parser.add_argument('--no-db', action='store_true', help="don't write results to the database")
+    args = parser.parse_args(argv)
+
+    fnames = list(find_images(args.paths))
+    if not fnames:
+        print('No images found.')
+        return 1
+    db = None
+    if not args.no_db:
+        db = LocalDBModel(args.db)
+        db.create_database()
+    print('Analyzing {} images with {} workers...'.format(len(fnames), args.workers))
+    done = 0
+    failed = 0
+    saved = 0
+    writes = []
+    busy = 0.0
+    ti = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker) as pool:
+        futures = [pool.submit(analyze_file, fname, args.margin, args.iterations, args.pyramid) for fname in fnames]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                fname, eyes, elapsed = future.result()
+            except Exception as e:
+                failed += 1
+                print('Error:', e)
+                continue
+            done += 1
+            busy += elapsed
+            if db is not None:
+                write = save_results(db, fname, eyes)
+                if write is not None:
+                    writes.append((fname, write))
+            print('{} R(BR={:.3f} BG={:.3f}) L(BR={:.3f} BG={:.3f})'.format(
+                os.path.basename(fname),
+                eyes['R']['BR'], eyes['R']['BG'],
+                eyes['L']['BR'], eyes['L']['BG']
+            ))
+    if db is not None:
+        for fname, write in writes:
+            try:
+                write.result()
+                saved += 1
+            except Exception as e:
+                print('Error saving {}: {}'.format(os.path.basename(fname), e))
+        db.close()
+    elapsed = time.perf_counter() - ti
+    print('\n{} images in {:.2f}s: {:.2f} images/s, {:.0f} ms/image per worker ({} failed, {} saved to the database)'.format(
+        done, elapsed, done / elapsed, 1000 * busy / max(done, 1), failed, saved
+    ))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+# MIT License
+
+# Copyright (c) 2021 Anderson R. Livramento
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import argparse
+import os
+import sys
+import timeit
+
+import cv2
+
+import dip
+
+from batch_analysis import find_images
+
+
+def imread_crop(fname, buffer):
+    # The previous path: the file MainWindow wrote, decoded whole, then cropped
+    return dip.crop_img(cv2.imread(fname))
+
+
+def memory_crop(fname, buffer):
+    return dip.crop_img(dip.decode_jpeg(buffer))
+
+
+def main(argv=None):
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Compares ways of getting the sample slice out of a capture JPEG.')
+    parser.add_argument('paths', nargs='*', default=[os.path.join(app_dir, 'imgs')], help='JPEG files or folders')
+    parser.add_argument('-n', '--number', type=int, default=20, help='decodes per measurement')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='measurements, the best one is reported')
+    args = parser.parse_args(argv)
+
+    fnames = list(find_images(args.paths))
+    if not fnames:
+        print('No images found.')
+        return 1
+    buffers = []
+    for fname in fnames:
+        with open(fname, 'rb') as fp:
+            buffers.append(fp.read())
+    methods = [
+        ('imread + crop_img', imread_crop),
+        ('imdecode + crop_img', memory_crop),
+        ('decode_crop', lambda fname, buffer: dip.decode_crop(buffer, use_turbo=False)),
+    ]
+    if dip.turbo_jpeg() is not None:
+        methods.append(('decode_crop turbojpeg', lambda fname, buffer: dip.decode_crop(buffer)))
+    else:
+        print('PyTurboJPEG not available, no lossless crop.')
+    for scale in (2, 4, 8):
+        methods.append((
+            'decode_crop 1/{}'.format(scale),
+            lambda fname, buffer, scale=scale: dip.decode_crop(buffer, scale=scale)
+        ))
+
+    reference = imread_crop(fnames[0], buffers[0])
+    print('{} images, slice {}x{}'.format(len(fnames), reference.shape[1], reference.shape[0]))
+    print('{:<24} {:>10} {:>8}  {}'.format('method', 'ms/image', 'speedup', 'slice'))
+    baseline = None
+    for name, method in methods:
+        def run():
+            for fname, buffer in zip(fnames, buffers):
+                method(fname, buffer)
+        best = min(timeit.repeat(run, number=args.number, repeat=args.repeat))
+        per_image = best / (args.number * len(fnames))
+        if baseline is None:
+            baseline = per_image
+        height, width = method(fnames[0], buffers[0]).shape[:2]
+        print('{:<24} {:10.2f} {:7.2f}x  {}x{}'.format(name, 1000 * per_image, baseline / per_image, width, height))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
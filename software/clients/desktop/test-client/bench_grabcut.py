@@ -0,0 +1,101 @@
+# MIT License
+
+# Copyright (c) 2021 Anderson R. Livramento
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import argparse
+import os
+import sys
+import time
+
+import cv2
+
+import numpy as np
+
+import dip
+
+from batch_analysis import find_images
+
+
+def mask_iou(mask_a, mask_b):
+    # Intersection over union of two final (0/1) masks
+    union = np.count_nonzero(mask_a | mask_b)
+    if union == 0:
+        return 1.0
+    return np.count_nonzero(mask_a & mask_b) / union
+
+
+def timed(function, *args, **kwargs):
+    ti = time.perf_counter()
+    result = function(*args, **kwargs)
+    return (result, time.perf_counter() - ti)
+
+
+def main(argv=None):
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Compares full resolution and coarse to fine GrabCut: time and IoU.')
+    parser.add_argument('paths', nargs='*', default=[os.path.join(app_dir, 'imgs')], help='JPEG files or folders')
+    parser.add_argument('-l', '--levels', type=int, nargs='+', default=[1, 2, 3], help='pyramid levels to try')
+    parser.add_argument('-m', '--margin', type=float, default=0.1, help='GrabCut rectangle inset, as a fraction of the eye ROI')
+    parser.add_argument('-i', '--iterations', type=int, default=5, help='GrabCut iterations')
+    args = parser.parse_args(argv)
+
+    cv2.setNumThreads(1)
+    full_time = 0.0
+    times = {levels: 0.0 for levels in args.levels}
+    ious = {levels: [] for levels in args.levels}
+    eyes = 0
+    for fname in find_images(args.paths):
+        sample_img_bgr = cv2.imread(fname)
+        if sample_img_bgr is None:
+            print('Unable to read', fname)
+            continue
+        img_croped = dip.sample_slice(sample_img_bgr)
+        for eye in (dip.right_eye(img_croped), dip.left_eye(img_croped)):
+            im_filtered = dip.filter_eye(eye)
+            rect = dip.default_rect(im_filtered, args.margin)
+            (gb_mask, _, _), elapsed = timed(dip.grab_cut_rect, im_filtered, rect, ite=args.iterations)
+            reference = dip.final_mask(gb_mask)
+            full_time += elapsed
+            for levels in args.levels:
+                (gb_mask, _, _), elapsed = timed(
+                    dip.grab_cut_pyramid, im_filtered, rect, levels=levels, ite=args.iterations
+                )
+                times[levels] += elapsed
+                ious[levels].append(mask_iou(reference, dip.final_mask(gb_mask)))
+            eyes += 1
+    if eyes == 0:
+        print('No images found.')
+        return 1
+    print('{} eyes, full resolution: {:.1f} ms/eye'.format(eyes, 1000 * full_time / eyes))
+    print('levels   ms/eye  speedup  mean IoU  min IoU')
+    for levels in args.levels:
+        print('{:6d} {:8.1f} {:7.2f}x {:9.4f} {:8.4f}'.format(
+            levels,
+            1000 * times[levels] / eyes,
+            full_time / max(times[levels], 1e-9),
+            float(np.mean(ious[levels])),
+            float(np.min(ious[levels]))
+        ))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,89 @@
+# MIT License
+
+# Copyright (c) 2021 Anderson R. Livramento
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import argparse
+import sys
+import timeit
+
+import cv2
+
+import numpy as np
+
+import gi
+gi.require_version('Gtk', '3.0')
+
+from gi.repository import GdkPixbuf
+
+import dip_gtk
+
+SIZES = ((457, 230), (640, 480), (1575, 400), (1920, 1080))
+
+
+def cv_to_pixbuf_pnm(cvimg, to_color=cv2.COLOR_BGR2RGB):
+    # The previous path: PNM text header and PixbufLoader parsing
+    rgb_image = cv2.cvtColor(cvimg, to_color)
+    height, width, depth = rgb_image.shape
+    try:
+        pnm_img = GdkPixbuf.PixbufLoader.new_with_type('pnm')
+        header = 'P6 {} {} 255\n'.format(width, height)
+        pnm_img.write(bytes(header, encoding='utf-8'))
+        pnm_img.write(rgb_image.tobytes())
+    finally:
+        pnm_img.close()
+    return pnm_img.get_pixbuf()
+
+
+def same_pixels(pixbuf_a, pixbuf_b):
+    # Rowstrides may differ, compare row by row
+    def rows(pixbuf):
+        pixels = pixbuf.get_pixels()
+        stride = pixbuf.get_rowstride()
+        row_len = pixbuf.get_width() * pixbuf.get_n_channels()
+        return [pixels[y * stride:y * stride + row_len] for y in range(pixbuf.get_height())]
+    return rows(pixbuf_a) == rows(pixbuf_b)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compares the PNM loader and the direct GBytes NumPy-to-Pixbuf paths.')
+    parser.add_argument('-n', '--number', type=int, default=200, help='conversions per measurement')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='measurements, the best one is reported')
+    args = parser.parse_args(argv)
+
+    print('      size      pnm ms   bytes ms  speedup')
+    for width, height in SIZES:
+        image = np.random.randint(0, 256, (height, width, 3), np.uint8)
+        if not same_pixels(cv_to_pixbuf_pnm(image), dip_gtk.cv_to_pixbuf(image)):
+            print('{}x{}: pixbufs differ!'.format(width, height))
+            return 1
+        pnm = min(timeit.repeat(lambda: cv_to_pixbuf_pnm(image), number=args.number, repeat=args.repeat))
+        direct = min(timeit.repeat(lambda: dip_gtk.cv_to_pixbuf(image), number=args.number, repeat=args.repeat))
+        print('{:>10} {:10.3f} {:10.3f} {:7.2f}x'.format(
+            '{}x{}'.format(width, height),
+            1000 * pnm / args.number,
+            1000 * direct / args.number,
+            pnm / direct
+        ))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
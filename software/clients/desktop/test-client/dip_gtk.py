@@ -0,0 +1,121 @@
+# MIT License
+
+# Copyright (c) 2021 Anderson R. Livramento
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import collections
+import weakref
+
+import cv2
+
+import gi
+gi.require_version('Gtk', '3.0')
+
+from gi.repository import GdkPixbuf, GLib
+
+# Pixbufs already shown by show_img, most recent last:
+# (id(cvimage), width, height, to_color) -> (weakref to cvimage, pixbuf).
+# GTK main loop only.
+DISPLAY_CACHE_SIZE = 8
+_display_cache = collections.OrderedDict()
+
+
+def _pixbuf_from_rgb(rgb_image):
+    # The pixbuf wraps a GBytes of the packed rows, with no encoding or
+    # parsing. PyGObject has no way to hand numpy memory to GLib, so the rows
+    # are still copied (tobytes, then into the GBytes)
+    height, width, depth = rgb_image.shape
+    return GdkPixbuf.Pixbuf.new_from_bytes(
+        GLib.Bytes.new(rgb_image.tobytes()),
+        GdkPixbuf.Colorspace.RGB,
+        False,
+        8,
+        width,
+        height,
+        width * depth
+    )
+
+
+def cv_to_pixbuf(cvimg, to_color=cv2.COLOR_BGR2RGB):
+    # Pixbufs here are always RGB without alpha
+    return _pixbuf_from_rgb(cv2.cvtColor(cvimg, to_color))
+
+
+def paste_to_pixbuf(pixbuf, cvimg, x, y, to_color=cv2.COLOR_BGR2RGB):
+    # Writes cvimg into pixbuf at (x, y), in place: only that region is
+    # converted and copied
+    region = cv_to_pixbuf(cvimg, to_color=to_color)
+    region.copy_area(0, 0, region.get_width(), region.get_height(), pixbuf, x, y)
+
+
+def invalidate_img(cvimage):
+    # To be called after changing cvimage in place, show_img can't tell
+    for key in [key for key in _display_cache if key[0] == id(cvimage)]:
+        del _display_cache[key]
+
+
+def _cached_pixbuf(key, cvimage):
+    entry = _display_cache.get(key)
+    if entry is None:
+        return None
+    if entry[0]() is not cvimage:
+        # Another array got the id of a freed one
+        del _display_cache[key]
+        return None
+    _display_cache.move_to_end(key)
+    return entry[1]
+
+
+def _cache_pixbuf(key, cvimage, pixbuf):
+    _display_cache[key] = (weakref.ref(cvimage), pixbuf)
+    while len(_display_cache) > DISPLAY_CACHE_SIZE:
+        _display_cache.popitem(last=False)
+
+
+def show_img(gtkimage, cvimage, to_color=cv2.COLOR_BGR2RGB):
+    # allocation = gtkimage.get_allocation()
+    allocation = gtkimage.get_size_request()
+    # request_size = gtkimage.get_size_request()
+    gtk_width, gtk_height = (allocation.width, allocation.height)
+    # print('GtkImage(w={}, h={})'.format(gtk_width, gtk_height))
+    # print('Requested Size: ', request_size)
+    # print('CVImage(w={}, h={})'.format(cvimage.shape[1], cvimage.shape[0]))
+    if len(cvimage.shape) > 2:
+        cv_height, cv_width, cv_depth = cvimage.shape
+    else:
+        cv_height, cv_width = cvimage.shape
+    new_image = cvimage
+    can_resize = False
+    if cv_height > gtk_height:
+        can_resize = True
+    else:
+        gtk_height = cv_height
+    if cv_width > gtk_width:
+        can_resize = True
+    else:
+        gtk_width = cv_width
+    key = (id(cvimage), gtk_width, gtk_height, to_color)
+    pixbuf = _cached_pixbuf(key, cvimage)
+    if pixbuf is None:
+        if can_resize:
+            new_image = cv2.resize(cvimage, (gtk_width, gtk_height), interpolation=cv2.INTER_AREA)
+        pixbuf = cv_to_pixbuf(new_image, to_color=to_color)
+        _cache_pixbuf(key, cvimage, pixbuf)
+    gtkimage.set_from_pixbuf(pixbuf)
@@ -24,11 +24,13 @@ import threading
 import socket
 import time
 import struct
-import io
 import base64
 import json
 import datetime
 import os
+import itertools
+import queue
+import concurrent.futures
 
 import gi
 gi.require_version('Gtk', '3.0')
@@ -43,45 +45,220 @@ from gi.repository import (
 
 import cv2
 
+import numpy as np
+
 import dip
+import protocol
 
 from acquire_window import AcquireWindow
 from model import LocalDBModel
 
 
+class LatestValue(object):
+    # One slot hand-off between threads: a new value replaces the one not
+    # taken yet, which is given back to the producer
+
+    def __init__(self):
+        self.value = None
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def put(self, value):
+        with self.cond:
+            replaced, self.value = self.value, value
+            self.cond.notify()
+        return replaced
+
+    def take(self):
+        with self.cond:
+            self.cond.wait_for(lambda: self.value is not None or self.closed)
+            value, self.value = self.value, None
+        return value
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class FrameScorer(threading.Thread):
+    # Focus and exposure of the eye ROIs (dip.preview_quality) for one of
+    # every `every` decoded preview frames, off the decoder thread. The
+    # newest offered frame wins; on_metrics runs on the GTK main loop.
+
+    def __init__(self, on_metrics, every=5):
+        super(FrameScorer, self).__init__()
+        self.daemon = True
+        self.on_metrics = on_metrics
+        self.every = every
+        self.offered = 0
+        self.frames = LatestValue()
+
+    def offer(self, frame):
+        # From the decoder thread, the frame must not change afterwards
+        self.offered += 1
+        if self.offered % self.every == 0:
+            self.frames.put(frame)
+
+    def run(self):
+        while True:
+            frame = self.frames.take()
+            if frame is None:
+                break
+            try:
+                metrics = dip.preview_quality(frame)
+            except cv2.error as e:
+                print('[FrameScorer] ERROR: ', e)
+                continue
+            GLib.idle_add(self.on_metrics, metrics)
+
+    def close(self):
+        self.frames.close()
+
+
 class CaptureClient(threading.Thread):
+    # Receive thread: frames are read straight into reusable buffers and handed
+    # to the decode worker, which only decodes the latest one. The GTK main
+    # loop has at most one paint pending, always showing the newest pixbuf.
 
-    def __init__(self, host='localhost', port=2323, img_ctx=None):
+    def __init__(self, host='localhost', port=2323, img_ctx=None, frame_capacity=128 * 1024, scorer=None):
         super(CaptureClient, self).__init__()
         self.host = host
         self.port = port
         self.img_ctx = img_ctx
+        # Optional FrameScorer, offered every decoded frame
+        self.scorer = scorer
         self.alive = threading.Event()
         self.alive.set()
+        # Receiving, waiting for the decoder and being decoded
+        self.free_buffers = queue.Queue()
+        for _ in range(3):
+            self.free_buffers.put(bytearray(frame_capacity))
+        self.received = LatestValue()
+        self.decoder = threading.Thread(target=self._decode_frames, daemon=True)
+        self.paint_lock = threading.Lock()
+        self.pending_pixbuf = None
+        self.frames_received = 0
+        self.frames_dropped = 0
 
     def run(self):
         client = socket.socket()
         client.connect((self.host, self.port))
-        stream = client.makefile('rb')
+        self.decoder.start()
+        if self.scorer is not None:
+            self.scorer.start()
+        header = bytearray(struct.calcsize('<L'))
         try:
             while self.alive.is_set():
-                img_len = struct.unpack('<L', stream.read(struct.calcsize('<L')))[0]
+                protocol.recv_into_exact(client, header)
+                img_len = struct.unpack('<L', header)[0]
                 if not img_len:
                     # Connection closed
                     print('[StreamCapture] Zero length detected!')
                     break
-                img_stream = io.BytesIO()
-                img_stream.write(stream.read(img_len))
-                img_stream.seek(0)
-                jpg_img = GdkPixbuf.PixbufLoader.new_with_type('jpeg')
-                jpg_img.write(img_stream.read())
-                jpg_img.close()
-                # self.img_ctx.set_from_pixbuf(jpg_img.get_pixbuf())
-                GLib.idle_add(self.img_ctx.set_from_pixbuf, jpg_img.get_pixbuf())
+                buffer = self.free_buffers.get()
+                if len(buffer) < img_len:
+                    buffer = bytearray(img_len)
+                protocol.recv_into_exact(client, memoryview(buffer)[:img_len])
+                self.frames_received += 1
+                replaced = self.received.put((buffer, img_len))
+                if replaced is not None:
+                    # Decoder is behind, the older frame is skipped
+                    self.frames_dropped += 1
+                    self.free_buffers.put(replaced[0])
+        except protocol.ProtocolError:
+            print('[StreamCapture] Connection closed.')
         finally:
-            stream.close()
+            self.received.close()
+            if self.scorer is not None:
+                self.scorer.close()
             client.close()
 
+    def _decode_frames(self):
+        while True:
+            item = self.received.take()
+            if item is None:
+                break
+            buffer, img_len = item
+            try:
+                frame = cv2.imdecode(np.frombuffer(buffer, np.uint8, img_len), cv2.IMREAD_COLOR)
+            finally:
+                self.free_buffers.put(buffer)
+            if frame is not None:
+                self._queue_paint(dip.cv_to_pixbuf(frame))
+                if self.scorer is not None:
+                    self.scorer.offer(frame)
+
+    def _queue_paint(self, pixbuf):
+        with self.paint_lock:
+            schedule = self.pending_pixbuf is None
+            self.pending_pixbuf = pixbuf
+        if schedule:
+            GLib.idle_add(self._paint)
+
+    def _paint(self):
+        with self.paint_lock:
+            pixbuf, self.pending_pixbuf = self.pending_pixbuf, None
+        self.img_ctx.set_from_pixbuf(pixbuf)
+        return False
+
+
+class CommandClient(threading.Thread):
+    # Keep-alive command connection: many requests in flight, the responses
+    # are matched back by request_id as they arrive
+
+    def __init__(self, host='localhost', port=8080):
+        super(CommandClient, self).__init__()
+        self.host = host
+        self.port = port
+        self.daemon = True
+        self.sock = None
+        self.send_lock = threading.Lock()
+        self.pending = {}
+        self.request_ids = itertools.count(1)
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port))
+        self.start()
+
+    def request(self, command, data=None):
+        request_id = next(self.request_ids)
+        request = dict(data or {}, command=command, request_id=request_id)
+        future = concurrent.futures.Future()
+        self.pending[request_id] = future
+        try:
+            with self.send_lock:
+                protocol.send_frame(self.sock, request)
+        except OSError:
+            self.pending.pop(request_id, None)
+            raise
+        return future
+
+    def run(self):
+        error = None
+        try:
+            while True:
+                meta, parts = protocol.read_frame(self.sock)
+                response = json.loads(meta)
+                future = self.pending.pop(response.pop('request_id', None), None)
+                if future is not None:
+                    future.set_result((response, dict(zip(response.get('attachments', []), parts))))
+        except (OSError, protocol.ProtocolError) as e:
+            error = e
+        finally:
+            # Whoever is still waiting gets the connection error
+            for request_id in list(self.pending):
+                self.pending.pop(request_id).set_exception(error or protocol.ProtocolError('Connection closed'))
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                with self.send_lock:
+                    protocol.send_frame(self.sock, {'connect': 'close'})
+            except OSError:
+                pass
+            self.sock.close()
+
 
 class MainWindow(object):
 
@@ -90,13 +267,34 @@ class MainWindow(object):
         self.vars = vars
         self.stream_connected = False
         self.terminator = '\r\n\r\n'
+        # 'binary' frames or the 'legacy' base64 protocol for old servers
+        self.command_protocol = getattr(self.vars, 'command_protocol', 'binary')
+        self.command_client = None
+        # The command connection is shared with the clock sync thread
+        self.command_lock = threading.Lock()
+        # Device clock minus ours, None until measured. Kept fresh by a
+        # background thread (zero shutter lag), only read on the shot path
+        self.clock_offset = None
+        self.clock_sync_stop = threading.Event()
         try:
             self.builder = Gtk.Builder.new_from_file('test-client-form.glade')
             self.builder.connect_signals(self)
         except GObject.GError:
             print('MainWindow:: Error reading GUI file')
             raise
-        self.capture_thread = CaptureClient(host=self.vars.server_host, img_ctx=self.builder.get_object('view_img'))
+        # Live focus/exposure, and the consecutive frames meeting the thresholds
+        self.good_frames = 0
+        self.auto_capture_armed = True
+        # AcquireWindow of the last sample, None once closed
+        self.acquire_window = None
+        # Preprocessor keys, unique per capture in this session
+        self.capture_keys = itertools.count(1)
+        self.scorer = FrameScorer(self._on_preview_metrics, every=getattr(self.vars, 'analysis_every', 5))
+        self.capture_thread = CaptureClient(
+            host=self.vars.server_host,
+            img_ctx=self.builder.get_object('view_img'),
+            scorer=self.scorer
+        )
         self.capture_thread.daemon = True
         self.main_window = self.builder.get_object('main_window')
         self.main_window.set_application(self.application)
@@ -116,7 +314,46 @@ class MainWindow(object):
             timedout = (datetime.datetime.now() - ti).seconds > timeout
         return data_in[:data_in.find(self.terminator)]
 
+    def _command(self, command, data=None, timeout=30):
+        # Commands share one keep-alive connection, reopened if it was lost
+        with self.command_lock:
+            if self.command_client is None or not self.command_client.is_alive():
+                self.command_client = CommandClient(host=self.vars.server_host, port=8080)
+                self.command_client.connect()
+        print('Sending command:', command, data)
+        response = self.command_client.request(command, data).result(timeout)
+        print('Done.')
+        return response
+
+    def _measure_clock_offset(self, samples=5):
+        # From status round trips, assuming each reply was made half way: the
+        # fastest round trip has the smallest error, the others are dropped
+        best_rtt = None
+        for i in range(samples):
+            ti = time.time()
+            response, _ = self._command('status')
+            tf = time.time()
+            if best_rtt is None or tf - ti < best_rtt:
+                best_rtt = tf - ti
+                offset = response['server_time'] - (ti + tf) / 2
+        self.clock_offset = offset
+
+    def _clock_sync_loop(self, interval=60):
+        # On connect, then every interval seconds, off the GTK thread: the
+        # round trips must not delay a shot past the device history
+        while not self.clock_sync_stop.is_set():
+            try:
+                self._measure_clock_offset()
+            except Exception as e:
+                print('Clock offset error:', e)
+            self.clock_sync_stop.wait(interval)
+
     def _post(self, data):
+        if self.command_protocol == 'legacy':
+            return self._post_legacy(data)
+        return self._command('capture', data)
+
+    def _post_legacy(self, data):
         # Data to send is base64 encoded
         json_bytes = json.dumps(data, ensure_ascii=False).encode('utf-8')
         data_b64 = base64.b64encode(json_bytes) + bytes(self.terminator, 'utf-8')
@@ -128,7 +365,12 @@ class MainWindow(object):
             data_b64 = self._readall(client)
             response_data = base64.b64decode(data_b64).decode('utf-8')
             print('Done.')
-        return response_data
+        response = json.loads(response_data)
+        attachments = {}
+        for name in response.get('attachments', ['sample_file_content']):
+            if name in response:
+                attachments[name] = base64.b64decode(response.pop(name))
+        return (response, attachments)
 
     def _get_radio_value(self, rd_ids):
         for rd_id, rd_value in rd_ids:
@@ -137,15 +379,56 @@ class MainWindow(object):
 
     def close(self, *args):
         self.capture_thread.alive.clear()
+        self.clock_sync_stop.set()
+        if self.command_client is not None:
+            self.command_client.close()
         # Wait finish connections
         time.sleep(1)
         self.main_window.destroy()
 
+    def _on_preview_metrics(self, metrics):
+        self.builder.get_object('lb_quality').set_text('Foco: {:.0f}   Brilho: {:.0f} / {:.0f}   Saturado: {:.1%}'.format(
+            metrics['sharpness'], metrics['brightness'][0], metrics['brightness'][1], metrics['clipped']
+        ))
+        min_brightness, max_brightness = getattr(self.vars, 'brightness_range', (60, 200))
+        good = (
+            metrics['sharpness'] >= getattr(self.vars, 'focus_threshold', 100.0)
+            and all(min_brightness <= b <= max_brightness for b in metrics['brightness'])
+            and metrics['clipped'] <= getattr(self.vars, 'max_clipped', 0.02)
+        )
+        if self.acquire_window is not None:
+            # No auto capture while a sample is being acquired
+            self.good_frames = 0
+            return False
+        if not good:
+            # Armed again once the eyes leave the thresholds, one shot per approach
+            self.good_frames = 0
+            self.auto_capture_armed = True
+            return False
+        self.good_frames += 1
+        if (getattr(self.vars, 'auto_capture', False) and self.auto_capture_armed
+                and self.good_frames >= getattr(self.vars, 'auto_capture_frames', 5)):
+            self.auto_capture_armed = False
+            print('Auto capture: {} good frames in a row'.format(self.good_frames))
+            self._on_btshot_click(None)
+        return False
+
+    def _open_acquire_window(self):
+        self.acquire_window = AcquireWindow(self.application, vars=self.vars)
+        self.acquire_window.acquire_window.connect('destroy', self._on_acquire_window_destroy)
+
+    def _on_acquire_window_destroy(self, widget):
+        self.acquire_window = None
+
     def _on_btconnect_click(self, widget):
             self.capture_thread.start()
             self.stream_connected = True
+            if getattr(self.vars, 'zero_shutter_lag', False) and self.command_protocol != 'legacy':
+                threading.Thread(target=self._clock_sync_loop, daemon=True).start()
 
     def _on_btshot_click(self, widget):
+        # The moment to capture, before anything else delays it
+        click_time = time.time()
         if self.stream_connected:
             # Build the JSON message
             sample_data = {
@@ -180,24 +463,47 @@ class MainWindow(object):
                 text_entry = text_entry.replace(',', '.')
                 sample_data['weight'] = float(text_entry)
             # TODO: Validade age, height and weight
-            response = self._post(sample_data)
+            # Capture options go with the request, not in the stored sample
+            request = dict(sample_data)
+            if getattr(self.vars, 'server_crop', False):
+                request['crop'] = list(dip.CROP_RECT)
+                if getattr(self.vars, 'capture_quality', None) is not None:
+                    request['quality'] = self.vars.capture_quality
+            if self.clock_offset is not None:
+                # The device picks its recorded frame of that moment, if it
+                # has one (zero shutter lag, clock synced in background)
+                request['shot_time'] = click_time + self.clock_offset
+            if getattr(self.vars, 'capture_burst', 1) > 1:
+                request['burst'] = self.vars.capture_burst
+            resp_obj, attachments = self._post(request)
             # Wait for response
-            if response:
-                resp_obj = json.loads(response)
+            if resp_obj and resp_obj.get('error'):
+                # Nothing to store locally, no image to show
+                print('Capture error:', resp_obj['error'])
+            elif resp_obj:
                 sample_data['remote_sample_file'] = resp_obj.get('sample_file')
+                if 'burst' in resp_obj:
+                    print('Burst scores:', resp_obj['burst']['scores'], 'kept', resp_obj['burst']['best'])
+                    sample_data['sharpness'] = resp_obj['burst']['score']
                 # Saving locally
                 self.vars.last_sample_id = self.vars.db.insert_sample(resp_obj['sample_id'], json.dumps(sample_data, ensure_ascii=False))
-                # Now decode the picture, slice and show
-                fcontent = base64.b64decode(resp_obj['sample_file_content'])
+                # Now save the picture, slice and show
+                fcontent = attachments['sample_file_content']
                 fname = os.path.basename(sample_data['remote_sample_file'])
                 flocal_name = '/'.join([self.vars.app_dir, 'imgs', fname])
                 with open(flocal_name, 'wb') as fp:
                     fp.write(fcontent)
-                # Reopen image as OpenCV matrix
-                sample_img_bgr = cv2.imread(flocal_name)
-                # Slice image
-                self.vars.sample_img_bgr = dip.crop_img(sample_img_bgr)
-                AcquireWindow(self.application, vars=self.vars)
+                if resp_obj.get('crop'):
+                    # The device already sent the slice only
+                    self.vars.sample_img_bgr = dip.decode_jpeg(fcontent)
+                else:
+                    # Only the slice is decoded, from the received bytes
+                    self.vars.sample_img_bgr = dip.decode_crop(fcontent)
+                # Eyes are filtered in background while the window opens. Keyed
+                # per capture: remote ids (and so file names) may repeat
+                self.vars.sample_key = ('capture', next(self.capture_keys))
+                self.vars.preprocessor.submit(self.vars.sample_key, self.vars.sample_img_bgr)
+                self._open_acquire_window()
         else:
             # Test
             print('Loading test imaging...')
@@ -205,7 +511,9 @@ class MainWindow(object):
             sample_img_bgr = cv2.imread('../data/imgs/eye-sample-2.jpg')
             # Slice image
             self.vars.sample_img_bgr = dip.crop_img(sample_img_bgr)
+            self.vars.sample_key = '../data/imgs/eye-sample-2.jpg'
+            self.vars.preprocessor.submit(self.vars.sample_key, self.vars.sample_img_bgr)
             # Test ID
             self.vars.last_sample_id = 1
-            AcquireWindow(self.application, vars=self.vars)
+            self._open_acquire_window()
         # print(sample_data)
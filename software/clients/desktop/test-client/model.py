@@ -20,8 +20,12 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import queue
 import sqlite3
+import contextlib
 import datetime
+import threading
+import concurrent.futures
 
 SAMPLE_TABLE = """
 create table if not exists local_samples (
@@ -32,49 +36,259 @@ create table if not exists local_samples (
 );
 """
 
+# Sample fields written by the client, exposed as typed columns generated
+# from the sample_data JSON, so they can be indexed and queried
+SAMPLE_FIELDS = (
+    ('age', 'integer', '$.age'),
+    ('height', 'real', '$.height'),
+    ('weight', 'real', '$.weight'),
+    ('gender', 'integer', '$.gender'),
+    ('is_diabetic', 'integer', '$.is_diabetic'),
+    ('dm_type', 'integer', '$.dm_type'),
+    ('diabetic_duration', 'text', '$.diabetic_duration'),
+    ('has_dr', 'integer', '$.has_DR'),
+    ('has_dnp', 'integer', '$.has_DNP'),
+    ('has_dnr', 'integer', '$.has_DNR'),
+    ('has_cdn', 'integer', '$.has_CDN'),
+    ('right_br', 'real', '$.eyes.R.BR'),
+    ('right_bg', 'real', '$.eyes.R.BG'),
+    ('left_br', 'real', '$.eyes.L.BR'),
+    ('left_bg', 'real', '$.eyes.L.BG'),
+)
+
+INDEXED_FIELDS = ('acquired_at', 'age', 'gender', 'is_diabetic', 'dm_type', 'right_br', 'left_br')
+
+
+def migration_1(table):
+    # dd/mm/YYYY dates to ISO 8601 (sortable) plus acquired_at epoch seconds,
+    # and the generated sample columns
+    script = [
+        'begin;',
+        "update {0} set acquisition_date = substr(acquisition_date, 7, 4) || '-' || "
+        "substr(acquisition_date, 4, 2) || '-' || substr(acquisition_date, 1, 2) || "
+        "substr(acquisition_date, 11) where acquisition_date like '__/__/____%';",
+        'alter table {0} add column acquired_at integer;',
+        "update {0} set acquired_at = cast(strftime('%s', acquisition_date, 'utc') as integer);",
+    ]
+    for name, column_type, path in SAMPLE_FIELDS:
+        script.append(
+            "alter table {{0}} add column {0} {1} generated always as "
+            "(json_extract(sample_data, '{2}')) virtual;".format(name, column_type, path)
+        )
+    for name in INDEXED_FIELDS:
+        script.append('create index if not exists {{0}}_{0} on {{0}}({0});'.format(name))
+    script.append('pragma user_version = 1;')
+    script.append('commit;')
+    return '\n'.join(script).format(table)
+
+
+# Schema version N is reached running MIGRATIONS[N-1]
+MIGRATIONS = (
+    migration_1,
+)
+
+# Generated columns (migration_1) came with SQLite 3.31
+MIN_SQLITE_VERSION = (3, 31, 0)
+
+PRAGMAS = (
+    'pragma journal_mode=WAL',
+    'pragma synchronous=NORMAL',
+    'pragma temp_store=MEMORY',
+    'pragma busy_timeout=5000',
+)
+
+
 class LocalDBModel(object):
+    # Long lived, one per process. Writes are queued to a writer thread
+    # which commits them in batches; reads borrow a connection from a small
+    # pool shared by every thread, running alongside the writer thanks to WAL.
 
-    def __init__(self, dbpath):
+    def __init__(self, dbpath, max_batch=64, max_readers=4):
         self.db_file = '/'.join((dbpath, 'eyellow_local_samples.db'))
-        self.conn = sqlite3.connect(self.db_file)
+        self.max_batch = max_batch
+        self.max_readers = max_readers
+        self.writes = queue.Queue()
+        self.readers = queue.LifoQueue()
+        self.reader_conns = []
+        self.readers_lock = threading.Lock()
+        # Opened here, so a bad path or database fails the caller instead
+        # of the writer thread
+        self.conn = self._connect()
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    @contextlib.contextmanager
+    def _reader(self):
+        # At most max_readers connections, whatever the number of threads
+        # reading; a thread waits for one to be given back once they are
+        # all open and in use
+        conn = None
+        try:
+            conn = self.readers.get_nowait()
+        except queue.Empty:
+            with self.readers_lock:
+                if len(self.reader_conns) < self.max_readers:
+                    conn = self._connect()
+                    self.reader_conns.append(conn)
+        if conn is None:
+            conn = self.readers.get()
+        try:
+            yield conn
+        finally:
+            self.readers.put(conn)
+
+    def _write(self, operation, wait=True):
+        # operation(cursor) runs on the writer thread; its result is
+        # available once the batch it belongs to is committed
+        future = concurrent.futures.Future()
+        self.writes.put((operation, future))
+        if wait:
+            return future.result()
+        return future
+
+    def _write_loop(self):
+        conn = self.conn
+        running = True
+        while running:
+            batch = [self.writes.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.writes.get_nowait())
+                except queue.Empty:
+                    break
+            done = []
+            for item in batch:
+                if item is None:
+                    running = False
+                    continue
+                operation, future = item
+                cursor = conn.cursor()
+                try:
+                    done.append((future, operation(cursor)))
+                except Exception as e:
+                    future.set_exception(e)
+                finally:
+                    cursor.close()
+            # One commit for the whole batch
+            try:
+                conn.commit()
+            except Exception as e:
+                # Nothing of a failed batch may reach the next commit
+                conn.rollback()
+                for future, _ in done:
+                    future.set_exception(e)
+                done = []
+            for future, result in done:
+                future.set_result(result)
+        conn.close()
+
+    def _execute(self, sql, params=(), wait=True):
+        def execute(cursor):
+            cursor.execute(sql, params)
+            return cursor.lastrowid
+        return self._write(execute, wait)
+
+    def flush(self):
+        # Wait every write queued so far to be committed
+        self._write(lambda cursor: None)
 
     def create_database(self):
         # Creating tables
-        cursor = self.conn.cursor()
-        cursor.execute(SAMPLE_TABLE)
-        cursor.close()
+        self._execute(SAMPLE_TABLE)
+        self.migrate()
+
+    def schema_version(self):
+        with self._reader() as conn:
+            return conn.execute('pragma user_version').fetchone()[0]
+
+    def migrate(self):
+        # Brings an existing database to the latest schema, in place
+        def migrate(cursor):
+            version = cursor.execute('pragma user_version').fetchone()[0]
+            if version < len(MIGRATIONS) and sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+                raise RuntimeError('SQLite {} or newer is needed for the samples schema, found {}'.format(
+                    '.'.join(map(str, MIN_SQLITE_VERSION)), sqlite3.sqlite_version
+                ))
+            for migration in MIGRATIONS[version:]:
+                try:
+                    cursor.executescript(migration('local_samples'))
+                except Exception:
+                    cursor.connection.rollback()
+                    raise
+            return len(MIGRATIONS)
+        return self._write(migrate)
 
     def insert_sample(self, remote_id, sample_data):
-        sql = 'insert into local_samples(acquisition_date, remote_id, sample_data) values(?,?,?)'
-        acquisition_date = datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')
-        cursor = self.conn.cursor()
-        cursor.execute(sql, (acquisition_date, remote_id, sample_data))
-        self.conn.commit()
-        sample_id = cursor.lastrowid
-        cursor.close()
-        return sample_id
-
-    def update_sample(self, sample_id, sample_data):
+        sql = 'insert into local_samples(acquisition_date, acquired_at, remote_id, sample_data) values(?,?,?,?)'
+        now = datetime.datetime.now()
+        acquisition_date = now.strftime('%Y-%m-%d %H:%M:%S')
+        return self._execute(sql, (acquisition_date, int(now.timestamp()), remote_id, sample_data))
+
+    def update_sample(self, sample_id, sample_data, wait=True):
         sql = 'update local_samples set sample_data = ? where id = ?'
-        cursor = self.conn.cursor()
-        cursor.execute(sql, (sample_data, sample_id))
-        self.conn.commit()
-        cursor.close()
+        return self._execute(sql, (sample_data, sample_id), wait)
 
-    def delete_sample(self, sample_id):
+    def delete_sample(self, sample_id, wait=True):
         sql = 'delete from local_samples where id = ?'
-        cursor = self.conn.cursor()
-        cursor.execute(sql, (sample_id,))
-        self.conn.commit()
-        cursor.close()
+        return self._execute(sql, (sample_id,), wait)
 
     def get_sample(self, sample_id):
         sql = 'select id, acquisition_date, remote_id, sample_data from local_samples where id = ?'
-        cursor = self.conn.cursor()
-        cursor.execute(sql, (sample_id,))
-        sample = cursor.fetchone()
-        cursor.close()
+        with self._reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute(sql, (sample_id,))
+            sample = cursor.fetchone()
+            cursor.close()
         return sample
 
+    def get_sample_by_remote_id(self, remote_id):
+        # Latest local sample of a remote (device) sample
+        sql = 'select id, acquisition_date, remote_id, sample_data from local_samples where remote_id = ? order by id desc'
+        with self._reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute(sql, (remote_id,))
+            sample = cursor.fetchone()
+            cursor.close()
+        return sample
+
+    def find_samples(self, since=None, until=None, **fields):
+        # Samples acquired between the since/until datetimes (range scan on
+        # acquired_at) with the given SAMPLE_FIELDS values, oldest first
+        where = []
+        params = []
+        if since is not None:
+            where.append('acquired_at >= ?')
+            params.append(int(since.timestamp()))
+        if until is not None:
+            where.append('acquired_at < ?')
+            params.append(int(until.timestamp()))
+        names = [name for name, _, _ in SAMPLE_FIELDS]
+        for name, value in fields.items():
+            if name not in names:
+                raise ValueError('Unknown sample field: {}'.format(name))
+            where.append('{} = ?'.format(name))
+            params.append(value)
+        sql = 'select id, acquisition_date, remote_id, sample_data from local_samples'
+        if where:
+            sql += ' where ' + ' and '.join(where)
+        sql += ' order by acquired_at'
+        with self._reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute(sql, params)
+            samples = cursor.fetchall()
+            cursor.close()
+        return samples
+
     def close(self):
-        self.conn.close()
+        self.writes.put(None)
+        self.writer.join()
+        with self.readers_lock:
+            for conn in self.reader_conns:
+                conn.close()
+            self.reader_conns = []
@@ -0,0 +1,74 @@
+# MIT License
+
+# Copyright (c) 2021 Anderson R. Livramento
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import collections
+import concurrent.futures
+import threading
+
+import dip
+
+EYES = (('R', dip.right_eye), ('L', dip.left_eye))
+
+
+class EyePreprocessor(object):
+    # Filtered eye ROIs (dip.filter_eye) per sample. Both eyes are filtered in
+    # parallel as soon as a sample is submitted and the most recently used
+    # samples are kept, up to max_bytes. The arrays are shared: callers must
+    # not change them in place.
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_workers=2):
+        self.max_bytes = max_bytes
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        # key -> {'R': future, 'L': future}, most recently used last
+        self.samples = collections.OrderedDict()
+        self.sizes = {}
+        self.total_bytes = 0
+
+    def submit(self, key, img_croped):
+        with self.lock:
+            if key in self.samples:
+                self.samples.move_to_end(key)
+                return self.samples[key]
+            eyes = {}
+            size = 0
+            for side, eye_roi in EYES:
+                eye_img = eye_roi(img_croped)
+                eyes[side] = self.executor.submit(dip.filter_eye, eye_img)
+                size += eye_img.nbytes
+            self.samples[key] = eyes
+            self.sizes[key] = size
+            self.total_bytes += size
+            # The newest sample stays, even alone over the cap
+            while self.total_bytes > self.max_bytes and len(self.samples) > 1:
+                old_key, old_eyes = self.samples.popitem(last=False)
+                for future in old_eyes.values():
+                    future.cancel()
+                self.total_bytes -= self.sizes.pop(old_key)
+            return eyes
+
+    def get(self, key, img_croped, side):
+        # Waits if that eye is still being filtered
+        return self.submit(key, img_croped)[side].result()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
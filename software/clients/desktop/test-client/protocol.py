@@ -0,0 +1,87 @@
+# MIT License
+
+# Copyright (c) 2021 Anderson R. Livramento
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import struct
+
+# Binary frame layout (all integers little endian):
+#
+#   header     magic(4) version(1) flags(1) parts count(2) metadata length(4)
+#   parts      one uint32 length for each binary part
+#   metadata   UTF-8 JSON document
+#   parts data raw bytes of every binary part, in order
+#
+# The metadata 'attachments' list names each binary part.
+MAGIC = b'\x89EYL'
+VERSION = 1
+HEADER = struct.Struct('<4sBBHI')
+PART_LENGTH = struct.Struct('<I')
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def recv_into_exact(sock, buffer):
+    view = memoryview(buffer)
+    while len(view):
+        read = sock.recv_into(view)
+        if not read:
+            raise ProtocolError('Connection closed while reading frame')
+        view = view[read:]
+    return buffer
+
+
+def recv_exact(sock, size):
+    return recv_into_exact(sock, bytearray(size))
+
+
+def pack_frame_head(meta, part_sizes, flags=0):
+    meta_bytes = json.dumps(meta, ensure_ascii=False).encode('utf-8')
+    head = bytearray(HEADER.pack(MAGIC, VERSION, flags, len(part_sizes), len(meta_bytes)))
+    for size in part_sizes:
+        head += PART_LENGTH.pack(size)
+    head += meta_bytes
+    return head
+
+
+def send_frame(sock, meta, attachments=()):
+    if attachments:
+        meta = dict(meta, attachments=[name for name, _ in attachments])
+    parts = [memoryview(content) for _, content in attachments]
+    sock.sendall(pack_frame_head(meta, [part.nbytes for part in parts]))
+    for part in parts:
+        sock.sendall(part)
+
+
+def read_frame(sock):
+    # Each part is received straight into its own bytearray, handed to the
+    # caller (replies may be in use while the next ones arrive)
+    magic, version, flags, parts_count, meta_len = HEADER.unpack(recv_exact(sock, HEADER.size))
+    if magic != MAGIC:
+        raise ProtocolError('Invalid frame magic: {!r}'.format(magic))
+    if version > VERSION:
+        raise ProtocolError('Unsupported frame version: {}'.format(version))
+    sizes = recv_exact(sock, PART_LENGTH.size * parts_count)
+    meta = recv_exact(sock, meta_len)
+    parts = [recv_exact(sock, size) for size, in PART_LENGTH.iter_unpack(sizes)]
+    return (meta, parts)
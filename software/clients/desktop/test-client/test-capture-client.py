@@ -34,11 +34,38 @@ from gi.repository import (
 
 from main_window import MainWindow
 from model import LocalDBModel
+from preprocess import EyePreprocessor
 
 class GlobalVars(object):
     server_host = 'localhost'
+    # 'binary' or 'legacy' (base64 JSON, for servers before the binary frames)
+    command_protocol = 'binary'
+    # Ask the device for the dip.CROP_RECT slice only (needs OpenCV on the
+    # device, which sends the full frame without it)
+    server_crop = False
+    # JPEG quality the device encodes that slice with, None for its default
+    capture_quality = None
+    # Frames per capture, the device keeps the sharpest (1 = single capture;
+    # needs OpenCV on the device, a single capture is taken without it)
+    capture_burst = 1
+    # Ask for the device recorded frame of the click moment instead of a new
+    # exposure (a burst when it has none that close). Needs ZSL_FRAMES set on
+    # the device
+    zero_shutter_lag = False
+    # Live preview scoring: one of every analysis_every frames. Good frames
+    # have focus (Laplacian variance) >= focus_threshold, both eyes mean gray
+    # level within brightness_range and at most max_clipped saturated. With
+    # auto_capture, auto_capture_frames good frames in a row take the shot
+    # (not while the acquisition window of the previous one is open).
+    analysis_every = 5
+    focus_threshold = 100.0
+    brightness_range = (60, 200)
+    max_clipped = 0.02
+    auto_capture = False
+    auto_capture_frames = 5
     app_dir = os.path.dirname(os.path.abspath(__file__))
     db = None
+    preprocessor = None
 
 
 class MyApplication(Gtk.Application):
@@ -58,5 +85,8 @@ if __name__ == '__main__':
     # Create the database
     vars.db = LocalDBModel(vars.app_dir)
     vars.db.create_database()
+    vars.preprocessor = EyePreprocessor()
     app = MyApplication('com.catfishlabs.eyellowcam_client', vars=vars)
     app.run()
+    vars.preprocessor.close()
+    vars.db.close()
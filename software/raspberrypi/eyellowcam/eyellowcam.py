@@ -20,13 +20,15 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import asyncio
+import io
+import signal
 import time
 import threading
 import queue
 import json
 import socket
-import socketserver
-import base64
+import concurrent.futures
 
 import picamera
 
@@ -36,97 +38,320 @@ from lib import (
     osutil,
     model,
 )
-from lib.socket_server import (
-    StreamServer,
-    BaseCommandProtocolHandler,
-)
+from lib.storage import DCIMWriter
+from lib.socket_server import StreamRecorder
+from lib.async_server import AsyncDeviceServer
 
 
 TURNED_ON_PIN = 5 # P29
 SHUTDOWN_PIN = 12 # P32
 DCIM_PATH = '/home/pi/DCIM'
+# 'memory': capture to RAM and send right away, DCIM is written in background
+# 'file': capture to DCIM and send the file
+CAPTURE_MODE = 'memory'
+# When a capture asks for a crop/size/quality, whether DCIM keeps the full
+# frame (True) or only what was sent
+ARCHIVE_FULL_FRAME = True
+# Coarse to fine GrabCut levels for on-device analysis (0 = full resolution)
+ANALYZE_PYRAMID_LEVELS = 2
+# Zero shutter lag: full HD frames kept (at 30 fps, 30 for one second) and
+# how far, in seconds, the closest one may be from the requested shot_time.
+# 0 turns it off: it switches the camera to a 16:9 full HD mode, not the VGA
+# one CROP_RECT was set on.
+ZSL_FRAMES = 0
+ZSL_MAX_DISTANCE = 0.25
+# Burst frames are scored on a 1/BURST_SCORE_SCALE decode of the slice
+BURST_SCORE_SCALE = 4
+# Every burst frame is kept in memory (full HD JPEG) until the best is known
+MAX_BURST_FRAMES = 10
 
 camera = picamera.PiCamera()
+# Keeps the last second of full HD frames for zero shutter lag captures
+recorder = StreamRecorder(camera, history_frames=ZSL_FRAMES)
+dcim_writer = DCIMWriter()
+camera_lock = threading.Lock()
+# Long lived, shared by every command
+db = model.DBModel()
+# Blocking work, off the event loop: captures one at a time, the rest
+# (SQLite, encoder start/stop) on a small pool
+camera_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+io_executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+# Scores burst frames while the next ones are captured
+burst_executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+# Set by the shutdown button: power off once the server stopped
+power_off = threading.Event()
+
+
+def opencv_available():
+    # Re-encoding (crop, size, quality) and scoring burst frames need OpenCV,
+    # which the device may lack
+    try:
+        import cv2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def analyze_capture(content):
+    # OpenCV is only loaded when the device is asked to analyze a capture
+    from lib import dip
+    if hasattr(content, 'read'):
+        fp = content
+        content = fp.read()
+        # The file may still be sent afterwards
+        fp.seek(0)
+    return dip.analyze_sample(dip.decode_jpeg(content), levels=ANALYZE_PYRAMID_LEVELS)
+
+
+def encode_region(content, crop=None, size=None, quality=None):
+    # The capture as the client asked for it: only the crop (x1, y1, x2, y2),
+    # resized to size (width, height), encoded at quality. Also needs OpenCV.
+    import cv2
+    from lib import dip
+    if crop is not None:
+        image = dip.decode_crop(content, rect=tuple(crop))
+    else:
+        image = dip.decode_jpeg(content)
+    if image is None:
+        raise ValueError('Unable to decode the capture')
+    if size is not None:
+        image = cv2.resize(image, tuple(size), interpolation=cv2.INTER_AREA)
+    params = []
+    if quality is not None:
+        params = [cv2.IMWRITE_JPEG_QUALITY, int(quality)]
+    ok, encoded = cv2.imencode('.jpg', image, params)
+    if not ok:
+        raise ValueError('Unable to encode the capture')
+    return memoryview(encoded)
+
+
+def history_frame(shot_time):
+    # Zero shutter lag: (JPEG, frame time) of the recorded frame closest to
+    # shot_time (device clock), None if there is none close enough
+    if recorder.history is None:
+        return None
+    frame = recorder.history.nearest(shot_time, max_distance=ZSL_MAX_DISTANCE)
+    if frame is None:
+        return None
+    try:
+        # Copied: the frame goes back to the pool right away
+        return (bytes(frame.payload()), frame.timestamp)
+    finally:
+        frame.release()
+
+
+def score_frame(content):
+    from lib import dip
+    img_croped = dip.decode_crop(content, scale=BURST_SCORE_SCALE)
+    if img_croped is None:
+        return 0.0
+    return dip.sharpness(img_croped, scale=BURST_SCORE_SCALE)
+
+
+def capture_burst(frames):
+    # frames JPEGs in a row from the video port (no still mode switch per
+    # frame), each one scored while the next is captured. Returns the
+    # sharpest one and the burst summary. Needs OpenCV.
+    streams = []
+    scores = []
+
+    def outputs():
+        for i in range(frames):
+            stream = io.BytesIO()
+            streams.append(stream)
+            yield stream
+            # Asked for the next output: this one is complete
+            scores.append(burst_executor.submit(score_frame, stream.getbuffer()))
 
-class CommandHandler(BaseCommandProtocolHandler):
+    camera.capture_sequence(outputs(), format='jpeg', use_video_port=True, splitter_port=3, resize=(1920, 1080))
+    scores = [future.result() for future in scores]
+    best = max(range(len(scores)), key=scores.__getitem__)
+    return (streams[best].getbuffer(), {'frames': frames, 'best': best, 'scores': scores, 'score': scores[best]})
 
-    def process_data(self, data):
+
+class DeviceCommands(object):
+    # Run by AsyncDeviceServer on its executors
+    default_command = 'capture'
+    allow_legacy = True
+
+    def cmd_capture(self, request):
         response = {
             'error': ''
         }
+        attachments = []
         try:
-            data_json = json.loads(data)
-            if data_json.get('connect') == 'close' and not self.connected:
-                print('Closing connection...')
-                self.close()
+            # Options, not sample data: compute the eye features on the device,
+            # whether the client still wants the image, and which part of it
+            analyze = request.pop('analyze', False)
+            send_image = request.pop('send_image', True)
+            crop = request.pop('crop', None)
+            size = request.pop('size', None)
+            quality = request.pop('quality', None)
+            burst = int(request.pop('burst', 1))
+            if not 1 <= burst <= MAX_BURST_FRAMES:
+                raise ValueError('burst must be between 1 and {}'.format(MAX_BURST_FRAMES))
+            shot_time = request.pop('shot_time', None)
+            reencode = send_image and (crop is not None or size is not None or quality is not None)
+            if reencode and not opencv_available():
+                # Decided before anything is stored: the client gets the full
+                # frame, as it can tell from the missing crop/size/quality
+                print('OpenCV not available, sending the full frame')
+                reencode = False
+            if burst > 1 and not opencv_available():
+                print('OpenCV not available, single capture instead of a burst')
+                burst = 1
+            data = json.dumps(request, ensure_ascii=False)
+            print('Received:', data)
+            sample_id = db.insert_sample(data)
+            sample_file = '{}/eye-sample-{}.jpg'.format(DCIM_PATH, sample_id)
+            response['sample_id'] = sample_id
+            response['sample_file'] = sample_file
+            past_frame = None
+            if shot_time is not None:
+                shot_time = float(shot_time)
+                past_frame = history_frame(shot_time)
+            if past_frame is not None:
+                content, frame_time = past_frame
+                print('Zero shutter lag frame, {:.3f}s from the shot, saving to {}'.format(frame_time - shot_time, sample_file))
+                response['frame_time'] = frame_time
+                if ARCHIVE_FULL_FRAME or not reencode:
+                    dcim_writer.save(sample_file, content)
+            else:
+                content = self.new_capture(sample_id, sample_file, request, response, burst, reencode)
+            if analyze:
+                # Always on the full frame
+                request['eyes'] = analyze_capture(content)
+                db.update_sample(sample_id, json.dumps(request, ensure_ascii=False))
+                response['eyes'] = request['eyes']
+            if reencode:
+                full_frame = content
+                if hasattr(full_frame, 'read'):
+                    full_frame = content.read()
+                    content.close()
+                content = encode_region(full_frame, crop, size, quality)
+                if not ARCHIVE_FULL_FRAME:
+                    dcim_writer.save(sample_file, content)
+                response['crop'] = crop
+                response['size'] = size
+                response['quality'] = quality
+            if send_image:
+                attachments.append(('sample_file_content', content))
+            elif hasattr(content, 'close'):
+                content.close()
+        except Exception as e:
+            response['error'] = str(e)
+            print('Error:\n\n', e)
+        return (response, attachments)
+
+    def new_capture(self, sample_id, sample_file, request, response, burst, reencode):
+        # New exposure(s): the JPEG as bytes-like, or the open DCIM file.
+        # Only one capture at a time on the still port
+        with camera_lock:
+            if burst > 1:
+                print('Capturing a burst of {} frames, saving the sharpest to {}'.format(burst, sample_file))
+                content, response['burst'] = capture_burst(burst)
+                request['sharpness'] = response['burst']['score']
+                db.update_sample(sample_id, json.dumps(request, ensure_ascii=False), wait=False)
+                if ARCHIVE_FULL_FRAME or not reencode:
+                    dcim_writer.save(sample_file, content)
+            elif CAPTURE_MODE == 'memory':
+                print('Capturing Image to memory, saving to ', sample_file)
+                stream = io.BytesIO()
+                camera.capture(stream, format='jpeg', splitter_port=3, resize=(1920, 1080))
+                content = stream.getbuffer()
+                if ARCHIVE_FULL_FRAME or not reencode:
+                    dcim_writer.save(sample_file, content)
             else:
-                print('Received:', data)
-                db = model.DBModel()
-                sample_id = db.insert_sample(data)
-                sample_file = '{}/eye-sample-{}.jpg'.format(DCIM_PATH, sample_id)
                 print('Capturing Image to file ', sample_file)
                 camera.capture(sample_file, splitter_port=3, resize=(1920, 1080))
                 # camera.capture(sample_file, splitter_port=3, resize=(3280, 1080))
                 # camera.capture(sample_file, use_video_port=True)
-                response['sample_id'] = sample_id
-                response['sample_file'] = sample_file
-                db.close()
-                # Open the file, b64 encode and send
-                with open(sample_file, 'rb') as fp:
-                    fbytes = fp.read()
-                # To b64
-                fb64 = base64.b64encode(fbytes)
-                # To response
-                response['sample_file_content'] = fb64.decode('utf-8')
-        except Exception as e:
-            response['error'] = str(e)
-            print('Error:\n\n', e)
-        self.send_data(json.dumps(response, ensure_ascii=False))
+                # Image goes back as a raw attachment, sent with sendfile straight
+                # from the file (base64 only for legacy clients)
+                content = open(sample_file, 'rb')
+        return content
+
+    def cmd_status(self, request):
+        response = {
+            'error': '',
+            'server_time': time.time(),
+            'capture_mode': CAPTURE_MODE,
+            'capturing': camera_lock.locked(),
+            'pending_writes': dcim_writer.pending.qsize(),
+            'stream_clients': device_server.stats(),
+        }
+        return (response, [])
+
+    def cmd_get_sample(self, request):
+        samples = db.get_sample(request['sample_id'])
+        if not samples:
+            return ({'error': 'Sample not found'}, [])
+        sample_id, acquisition_date, sample_data = samples[0]
+        response = {
+            'error': '',
+            'sample_id': sample_id,
+            'acquisition_date': acquisition_date,
+            'sample_data': json.loads(sample_data),
+        }
+        return (response, [])
 
 
-def setup_shutdown_button(stream_server):
+device_server = AsyncDeviceServer(
+    recorder,
+    DeviceCommands(),
+    executors={'capture': camera_executor},
+    default_executor=io_executor
+)
+
+
+def setup_shutdown_button(device_server):
     def button_shutdown_pressed(channel):
         if channel == SHUTDOWN_PIN:
-            stream_server.alive.clear()
-            # Wait StreamServer thread ends
-            time.sleep(1)
-            # Shutdown device
-            print('|----->[ SHUTING DOWN ]<-----|')
-            osutil.shutdown()
+            # GPIO thread, maybe before the server started: the event loop
+            # does the stopping, as soon as it runs
+            power_off.set()
+            device_server.request_stop()
     return button_shutdown_pressed
 
 
-def init_hw(stream_server):
+def init_hw(device_server):
     GPIO.setmode(GPIO.BCM)
     GPIO.setup(TURNED_ON_PIN, GPIO.OUT, initial=GPIO.LOW)
     GPIO.setup(SHUTDOWN_PIN, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
     # Button event
-    GPIO.add_event_detect(SHUTDOWN_PIN, GPIO.RISING, callback=setup_shutdown_button(stream_server))
+    GPIO.add_event_detect(SHUTDOWN_PIN, GPIO.RISING, callback=setup_shutdown_button(device_server))
+
+
+async def serve():
+    await device_server.start()
+    loop = asyncio.get_event_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, device_server.request_stop)
+    # Before serving, turn on ready LED
+    GPIO.output(TURNED_ON_PIN, GPIO.HIGH)
+    await device_server.serve_until_stopped()
 
 
 # self.camera.capture(sample_file, splitter_port=3, resize=(3280, 1080))
 
 
 if __name__ == '__main__':
-    stream_server = StreamServer(camera=camera)
-    stream_server.daemon = True
-    init_hw(stream_server)
+    init_hw(device_server)
     # Initialize Database
-    db = model.DBModel()
     db.create_database()
-    db.close()
-    del db
-    # Starts streaming
-    stream_server.start()
-    # Before start forever, turn on ready LED
-    GPIO.output(TURNED_ON_PIN, GPIO.HIGH)
-    print('Start Listening on 0.0.0.0:8080...')
+    dcim_writer.start()
     try:
-        cmd_server = socketserver.TCPServer(('0.0.0.0', 8080), CommandHandler)
-        cmd_server.serve_forever()
+        asyncio.run(serve())
     finally:
-        cmd_server.server_close()
-        stream_server.alive.clear()
-        # waiting close all
-        time.sleep(1)
+        # Connections and queued commands were cancelled by the server, the
+        # running ones finish here
+        camera_executor.shutdown()
+        burst_executor.shutdown()
+        io_executor.shutdown()
+        # Images still in memory must reach the SD card
+        dcim_writer.stop()
+        db.close()
         GPIO.output(TURNED_ON_PIN, GPIO.LOW)
+        if power_off.is_set():
+            print('|----->[ SHUTING DOWN ]<-----|')
+            osutil.shutdown()
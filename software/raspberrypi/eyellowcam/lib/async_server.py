@@ -0,0 +1,313 @@
+# MIT License
+
+# Copyright (c) 2021 Anderson R. Livramento
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import asyncio
+import base64
+import json
+import socket
+
+from lib import protocol
+
+
+class AsyncStreamClient(object):
+    # Counters of one stream connection, reported by the status command
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+
+    def stats(self):
+        return {
+            'address': '{}:{}'.format(*self.addr[:2]),
+            'frames_sent': self.frames_sent,
+            'frames_dropped': self.frames_dropped,
+            'queue_depth': self.queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+        }
+
+
+class AsyncDeviceServer(object):
+    # Stream and command ports on one asyncio event loop: connections are
+    # coroutines, not threads. The camera encoders (a StreamRecorder) publish
+    # from their own thread and wake the stream coroutines through a
+    # broadcaster listener. Commands are the cmd_<name>(request) methods of
+    # `commands` (returning (response, attachments) as for
+    # BaseCommandProtocolHandler), run on executors[name] or
+    # default_executor since they block on the camera or SQLite.
+
+    terminator = '\r\n\r\n'
+    # Seconds a legacy base64 request may take to arrive
+    legacy_timeout = 2
+
+    def __init__(self, recorder, commands, executors=None, default_executor=None,
+                 host='0.0.0.0', stream_port=2323, command_port=8080,
+                 max_queue=1, send_buffer=64 * 1024):
+        self.recorder = recorder
+        self.broadcaster = recorder.broadcaster
+        self.commands = commands
+        self.executors = executors or {}
+        self.default_executor = default_executor
+        self.host = host
+        self.stream_port = stream_port
+        self.command_port = command_port
+        self.max_queue = max_queue
+        self.send_buffer = send_buffer
+        self.loop = None
+        self.servers = []
+        # Connection and request tasks, cancelled on stop
+        self.tasks = set()
+        self.clients = []
+        self.frame_waiter = None
+        self.stopped = None
+        # Set by request_stop even before start, then honoured by start
+        self.stop_requested = False
+
+    def stats(self):
+        return [client.stats() for client in self.clients]
+
+    def _track(self, task):
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def start(self):
+        # stopped first: request_stop uses it as soon as loop is set
+        self.stopped = asyncio.Event()
+        self.loop = asyncio.get_event_loop()
+        self.frame_waiter = self.loop.create_future()
+        self.broadcaster.listeners.append(
+            lambda: self.loop.call_soon_threadsafe(self._frame_published)
+        )
+        await self.loop.run_in_executor(self.default_executor, self.recorder.start)
+        self.servers = [
+            await asyncio.start_server(self._serve_stream, self.host, self.stream_port),
+            await asyncio.start_server(self._serve_commands, self.host, self.command_port),
+        ]
+        self._track(self.loop.create_task(self._watch_recording()))
+        print('\n[DeviceServer] Stream on {}, commands on {}'.format(self.stream_port, self.command_port))
+        if self.stop_requested:
+            # Asked while starting: request_stop had no loop to call yet
+            self.stopped.set()
+
+    def request_stop(self):
+        # Thread safe (GPIO callbacks, signal handlers), and may come before
+        # start: the flag is set first, start checks it once the loop is known
+        self.stop_requested = True
+        loop = self.loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self.stopped.set)
+
+    async def serve_until_stopped(self):
+        await self.stopped.wait()
+        await self.stop()
+
+    async def stop(self):
+        # No new connections, then every connection and request is cancelled
+        # (queued executor work with it) and awaited, then the encoders stop.
+        # wait_closed() comes last: since Python 3.12.1 it also waits for the
+        # open connections, which only end once their tasks are cancelled.
+        for server in self.servers:
+            server.close()
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for server in self.servers:
+            await server.wait_closed()
+        await self.loop.run_in_executor(self.default_executor, self.recorder.stop)
+        print('\n[DeviceServer] Stopped.')
+
+    async def _watch_recording(self):
+        # Encoder errors stop the server instead of going unnoticed
+        try:
+            while True:
+                await asyncio.sleep(1)
+                self.recorder.check()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print('\n[DeviceServer] Recording ERROR: ', e)
+            self.stopped.set()
+
+    # Stream ################################################################
+
+    def _frame_published(self):
+        # Wakes every stream coroutine waiting for a frame
+        waiter, self.frame_waiter = self.frame_waiter, self.loop.create_future()
+        if not waiter.done():
+            waiter.set_result(None)
+
+    async def _serve_stream(self, reader, writer):
+        self._track(asyncio.current_task())
+        client = AsyncStreamClient(writer.get_extra_info('peername'))
+        self.clients.append(client)
+        print('\n[DeviceServer] Stream connected to: ', client.addr)
+        if self.send_buffer:
+            # A big kernel buffer would queue seconds of video on a slow link
+            writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer)
+        # drain() returns only once the transport sent everything, so the
+        # pooled frame can be released right after
+        writer.transport.set_write_buffer_limits(high=0)
+        # Starts from the next frame published
+        cursor = self.broadcaster.seq
+        try:
+            while True:
+                item = self.broadcaster.next_frame(cursor, timeout=0, max_queue=self.max_queue)
+                if item is None:
+                    if self.broadcaster.closed:
+                        break
+                    # Shielded: a cancelled client must not cancel the
+                    # waiter every client shares
+                    await asyncio.shield(self.frame_waiter)
+                    continue
+                seq, frame = item
+                # Frames waiting when the client got ready, and the stale ones skipped
+                client.queue_depth = self.broadcaster.seq - cursor
+                client.frames_dropped += seq - cursor - 1
+                client.max_queue_depth = max(client.max_queue_depth, client.queue_depth)
+                cursor = seq
+                try:
+                    writer.write(frame.packet())
+                    await writer.drain()
+                finally:
+                    frame.release()
+                client.frames_sent += 1
+        except (BrokenPipeError, ConnectionResetError):
+            # Client went away
+            pass
+        except asyncio.CancelledError:
+            # Server stopping, the connection task ends here
+            pass
+        finally:
+            self.clients.remove(client)
+            writer.close()
+            print('\n[DeviceServer] Stream connection closed: ', client.addr, client.stats())
+
+    # Commands ##############################################################
+
+    async def _serve_commands(self, reader, writer):
+        self._track(asyncio.current_task())
+        send_lock = asyncio.Lock()
+        # Requests of this connection still running
+        requests = set()
+        try:
+            head = await reader.readexactly(len(protocol.MAGIC))
+            if head != protocol.MAGIC:
+                await self._serve_legacy(head, reader, writer)
+                return
+            # Keep-alive: the connection carries many requests, each one
+            # answered as soon as it is done, tagged with its request_id
+            while True:
+                meta, _ = await protocol.read_frame_async(reader, head)
+                head = b''
+                try:
+                    request = self._parse_request(meta)
+                except ValueError as e:
+                    # Answered with the error by _process
+                    request = e
+                if isinstance(request, dict) and request.get('connect') == 'close':
+                    break
+                task = self._track(self.loop.create_task(self._process(request, writer, send_lock, True)))
+                requests.add(task)
+                task.add_done_callback(requests.discard)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, protocol.ProtocolError,
+                ConnectionError, asyncio.TimeoutError):
+            # Connection closed, or a legacy request too long or too slow
+            pass
+        except asyncio.CancelledError:
+            # Server stopping, the connection task ends here
+            pass
+        finally:
+            # Requests of this connection end before it is closed, whatever
+            # ended it (cancelled ones return right away)
+            if requests:
+                await asyncio.gather(*list(requests), return_exceptions=True)
+            writer.close()
+
+    async def _serve_legacy(self, head, reader, writer):
+        if not getattr(self.commands, 'allow_legacy', True):
+            print('[DeviceServer] Legacy request refused.')
+            return
+        data = head + await asyncio.wait_for(
+            reader.readuntil(self.terminator.encode('utf-8')), self.legacy_timeout
+        )
+        try:
+            request = self._parse_request(data[:-len(self.terminator)], legacy=True)
+        except ValueError as e:
+            request = e
+        await self._process(request, writer, asyncio.Lock(), False)
+
+    def _parse_request(self, data, legacy=False):
+        # The request object of a frame metadata, or of a legacy base64
+        # payload. ValueError (binascii.Error, JSONDecodeError and
+        # UnicodeDecodeError are ones) when it isn't one.
+        if legacy:
+            data = base64.b64decode(data)
+        request = json.loads(data)
+        if not isinstance(request, dict):
+            raise ValueError('Request must be a JSON object')
+        return request
+
+    async def _process(self, request, writer, send_lock, binary):
+        # request: a _parse_request result, or the error it raised, which is
+        # sent back like any command error
+        request_id = None
+        attachments = []
+        try:
+            try:
+                if isinstance(request, ValueError):
+                    raise request
+                request_id = request.pop('request_id', None)
+                command = request.pop('command', getattr(self.commands, 'default_command', None))
+                handler = getattr(self.commands, 'cmd_{}'.format(command), None)
+                if handler is None:
+                    response = {'error': 'Unknown command: {}'.format(command)}
+                else:
+                    executor = self.executors.get(command, self.default_executor)
+                    response, attachments = await self.loop.run_in_executor(executor, handler, request)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                response = {'error': str(e)}
+                print('Error:\n\n', e)
+            if request_id is not None:
+                response['request_id'] = request_id
+            async with send_lock:
+                if binary:
+                    await protocol.send_frame_async(writer, response, attachments)
+                else:
+                    # Reads the attachment files and base64 encodes them:
+                    # off the loop, like the command itself
+                    data = await self.loop.run_in_executor(
+                        self.default_executor, protocol.encode_legacy, response, attachments, self.terminator
+                    )
+                    writer.write(data)
+                    await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            for _, content in attachments:
+                if hasattr(content, 'close'):
+                    content.close()
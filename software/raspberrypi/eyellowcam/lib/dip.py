@@ -0,0 +1,346 @@
+# MIT License
+
+# Copyright (c) 2021 Anderson R. Livramento
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import cv2
+
+import numpy as np
+
+CROP_RECT = (125, 325, 1700, 725)
+CENTER_OFFSET = 250
+TOP_OFFSET = 150
+BOTTOM_OFFSET = 380
+LEFT_OFFSET = 80
+RIGHT_OFFSET = 1494
+
+# Same core as the desktop client dip.py, so the device can compute the eye
+# features next to the camera and answer with numbers only. Changes to the
+# shared functions go to both copies, like protocol.py and model.py.
+
+
+def decode_jpeg(buffer, flags=cv2.IMREAD_COLOR):
+    # Decodes straight from a bytes-like object, without a copy
+    return cv2.imdecode(np.frombuffer(buffer, np.uint8), flags)
+
+
+def crop_img(image):
+    return image[CROP_RECT[1]:CROP_RECT[3], CROP_RECT[0]:CROP_RECT[2]].copy()
+
+
+def sample_slice(image):
+    # crop_img, unless the image already is the slice (a capture the device
+    # was asked to crop)
+    if image.shape[:2] == (CROP_RECT[3] - CROP_RECT[1], CROP_RECT[2] - CROP_RECT[0]):
+        return image
+    return crop_img(image)
+
+
+# libjpeg can decode at 1/2, 1/4 and 1/8 of the size, skipping most of the work
+REDUCED_MODES = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+# Lossless JPEG crops start on an MCU, 16 covers every chroma subsampling
+JPEG_MCU = 16
+_turbo_jpeg = []
+
+
+def turbo_jpeg():
+    # PyTurboJPEG (pip install PyTurboJPEG, and libturbojpeg) is optional,
+    # None when it is missing: decode_crop then decodes the whole frame
+    if not _turbo_jpeg:
+        try:
+            from turbojpeg import TurboJPEG
+            _turbo_jpeg.append(TurboJPEG())
+        except (ImportError, OSError):
+            _turbo_jpeg.append(None)
+    return _turbo_jpeg[0]
+
+
+def decode_crop(buffer, scale=1, rect=CROP_RECT, use_turbo=True):
+    # crop_img straight from the JPEG in memory, optionally at 1/scale size.
+    # With PyTurboJPEG only the MCU rows and columns around rect are cut
+    # (losslessly) and decoded, otherwise the whole frame is decoded.
+    x1, y1, x2, y2 = rect
+    jpeg = turbo_jpeg() if use_turbo else None
+    if jpeg is not None:
+        mx, my = x1 - x1 % JPEG_MCU, y1 - y1 % JPEG_MCU
+        buffer = jpeg.crop(bytes(buffer), mx, my, x2 - mx, y2 - my)
+        x1, y1, x2, y2 = x1 - mx, y1 - my, x2 - mx, y2 - my
+    image = decode_jpeg(buffer, REDUCED_MODES[scale])
+    if image is None:
+        return None
+    crop = image[y1 // scale:y2 // scale, x1 // scale:x2 // scale]
+    if crop.shape != image.shape:
+        # Like crop_img, don't keep the whole decoded frame alive
+        crop = crop.copy()
+    return crop
+
+
+class GrabCutCancelled(Exception):
+    pass
+
+
+def _grab_cut(image, mask, rect, bg_model, fg_model, ite, mode, progress=None, cancel=None, tolerance=None):
+    # One cv2.grabCut iteration per call, the models carry over (GC_EVAL), so
+    # progress can be reported and cancellation checked between iterations.
+    # With a tolerance, stops once less than that fraction of the pixels
+    # changed side since the previous iteration.
+    previous = None
+    for i in range(ite):
+        if cancel is not None and cancel.is_set():
+            raise GrabCutCancelled()
+        cv2.grabCut(image, mask, rect, bg_model, fg_model, 1, mode)
+        mode = cv2.GC_EVAL
+        converged = False
+        if tolerance is not None:
+            current = final_mask(mask)
+            if previous is not None:
+                converged = np.count_nonzero(current != previous) <= tolerance * current.size
+            previous = current
+        if progress is not None:
+            progress(ite if converged else i + 1, ite)
+        if converged:
+            break
+    return mask
+
+
+def grab_cut_rect(image, rect, ite=5, bg_model=None, fg_model=None, progress=None, cancel=None, tolerance=None):
+    mask = np.zeros(image.shape[:2], np.uint8)
+    if bg_model is None:
+        bg_model = np.zeros((1, 65), np.float64)
+    if fg_model is None:
+        fg_model = np.zeros((1, 65), np.float64)
+    # rect = (ix, iy, fx, fy) -> w = abs(ix-fx) ; h = abs(iy-fy)
+    gc_rect = (rect[0], rect[1], abs(rect[0]-rect[2]), abs(rect[1]-rect[3]))
+    _grab_cut(image, mask, gc_rect, bg_model, fg_model, ite, cv2.GC_INIT_WITH_RECT, progress, cancel, tolerance)
+    return (mask, bg_model, fg_model)
+
+
+def grab_cut_mask(image, mask, bg_model, fg_model, ite=5, progress=None, cancel=None, tolerance=None):
+    if bg_model is None:
+        bg_model = np.zeros((1, 65), np.float64)
+    if fg_model is None:
+        fg_model = np.zeros((1, 65), np.float64)
+    _grab_cut(image, mask, None, bg_model, fg_model, ite, cv2.GC_INIT_WITH_MASK, progress, cancel, tolerance)
+    return (mask, bg_model, fg_model)
+
+
+def grab_cut_pyramid(image, rect, levels=2, ite=5, refine_ite=2, band=None, tolerance=0.001,
+                     bg_model=None, fg_model=None, progress=None, cancel=None):
+    # Coarse to fine grab_cut_rect: segments an image levels times pyrDown'ed,
+    # then upsamples the mask and lets GrabCut decide only a band of band
+    # pixels around its contour, at full resolution and inside the band's
+    # bounding box. Returns the same (mask, bg_model, fg_model) as grab_cut_rect.
+    scale = 2 ** levels
+    if band is None:
+        band = 2 * scale
+    coarse_progress = None
+    refine_progress = None
+    if progress is not None:
+        coarse_progress = lambda done, total: progress(done, 2 * total)
+        refine_progress = lambda done, total: progress(total + done, 2 * total)
+    small = image
+    for _ in range(levels):
+        small = cv2.pyrDown(small)
+    small_rect = tuple(int(v) // scale for v in rect)
+    small_mask, bg_model, fg_model = grab_cut_rect(
+        small, small_rect, ite, bg_model, fg_model, coarse_progress, cancel, tolerance
+    )
+
+    height, width = image.shape[:2]
+    fg = cv2.resize(final_mask(small_mask), (width, height), interpolation=cv2.INTER_NEAREST)
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * band + 1, 2 * band + 1))
+    sure_fg = cv2.erode(fg, kernel)
+    maybe_fg = cv2.dilate(fg, kernel)
+    mask = np.full((height, width), cv2.GC_BGD, np.uint8)
+    mask[maybe_fg == 1] = cv2.GC_PR_BGD
+    mask[fg == 1] = cv2.GC_PR_FGD
+    mask[sure_fg == 1] = cv2.GC_FGD
+    # Outside the user rectangle is background, as in grab_cut_rect
+    x1, y1 = max(min(rect[0], rect[2]), 0), max(min(rect[1], rect[3]), 0)
+    x2, y2 = max(rect[0], rect[2]), max(rect[1], rect[3])
+    outside = np.ones((height, width), bool)
+    outside[y1:y2, x1:x2] = False
+    mask[outside] = cv2.GC_BGD
+
+    uncertain = (mask == cv2.GC_PR_BGD) | (mask == cv2.GC_PR_FGD)
+    rows = np.flatnonzero(uncertain.any(axis=1))
+    cols = np.flatnonzero(uncertain.any(axis=0))
+    if rows.size == 0:
+        # Nothing uncertain left (or nothing found at all)
+        if progress is not None:
+            progress(1, 1)
+        return (mask, bg_model, fg_model)
+    # Some definite background around the band keeps both models fed
+    ry1, ry2 = max(rows[0] - band, 0), min(rows[-1] + band + 1, height)
+    rx1, rx2 = max(cols[0] - band, 0), min(cols[-1] + band + 1, width)
+    roi_mask = mask[ry1:ry2, rx1:rx2].copy()
+    roi_image = np.ascontiguousarray(image[ry1:ry2, rx1:rx2])
+    # GC_EVAL keeps refining the coarse models instead of starting over
+    _grab_cut(roi_image, roi_mask, None, bg_model, fg_model, refine_ite, cv2.GC_EVAL,
+              refine_progress, cancel, tolerance)
+    mask[ry1:ry2, rx1:rx2] = roi_mask
+    return (mask, bg_model, fg_model)
+
+
+def final_mask(gb_mask):
+    # Definite and probable foreground as 1, everything else 0
+    return np.where((gb_mask==2)|(gb_mask==0), 0, 1).astype('uint8')
+
+
+def default_rect(image, margin=0.1):
+    # GrabCut rectangle for unattended runs: the image inset by margin
+    height, width = image.shape[:2]
+    mx, my = int(width * margin), int(height * margin)
+    return (mx, my, width - mx, height - my)
+
+
+def right_eye(img_croped):
+    half = img_croped.shape[1] // 2
+    return img_croped[TOP_OFFSET:BOTTOM_OFFSET, LEFT_OFFSET:(half-CENTER_OFFSET)].copy()
+
+
+def left_eye(img_croped):
+    half = img_croped.shape[1] // 2
+    return img_croped[TOP_OFFSET:BOTTOM_OFFSET, (half+CENTER_OFFSET):RIGHT_OFFSET].copy()
+
+
+def eye_rects(img_croped, scale=1):
+    # (x1, y1, x2, y2) of the right and left eye ROIs, in an image at 1/scale
+    half = img_croped.shape[1] // 2
+    top, bottom = TOP_OFFSET // scale, BOTTOM_OFFSET // scale
+    return (
+        (LEFT_OFFSET // scale, top, half - CENTER_OFFSET // scale, bottom),
+        (half + CENTER_OFFSET // scale, top, RIGHT_OFFSET // scale, bottom),
+    )
+
+
+def sharpness(img_croped, scale=1):
+    # Focus measure: variance of the Laplacian over each eye ROI. The
+    # blurrier eye (motion, blink) decides.
+    gray = img_croped
+    if len(gray.shape) > 2:
+        gray = cv2.cvtColor(gray, cv2.COLOR_BGR2GRAY)
+    scores = []
+    for x1, y1, x2, y2 in eye_rects(gray, scale):
+        _, stddev = cv2.meanStdDev(cv2.Laplacian(gray[y1:y2, x1:x2], cv2.CV_16S))
+        scores.append(float(stddev[0][0]) ** 2)
+    return min(scores)
+
+
+def filter_eye(eye_img):
+    # Edge preserving smoothing every segmentation starts from
+    return cv2.bilateralFilter(eye_img, 9, 75, 75)
+
+
+def _ratio(numerator, denominator):
+    return numerator / denominator if denominator else 0.0
+
+
+def _hist_percentiles(hist, count, percentiles):
+    # Smallest value with at least p% of the masked pixels at or below it
+    cdf = np.cumsum(hist)
+    return [int(np.searchsorted(cdf, max(count * p / 100.0, 1))) for p in percentiles]
+
+
+def masked_stats_batch(image, masks, percentiles=(10, 50, 90), hue_bins=18):
+    # Statistics of the image pixels under each mask (nonzero = inside),
+    # accumulated by OpenCV through the mask: no pixel is gathered or copied.
+    # The Lab and HSV conversions are done once for all the masks.
+    lab = cv2.cvtColor(image, cv2.COLOR_BGR2Lab)
+    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+    results = []
+    for mask in masks:
+        count = cv2.countNonZero(mask)
+        if count == 0:
+            results.append(None)
+            continue
+        b, g, r, _ = cv2.mean(image, mask=mask)
+        # 8 bit Lab: b* is stored offset by 128
+        lab_b = cv2.mean(lab, mask=mask)[2] - 128.0
+        hue_hist = cv2.calcHist([hsv], [0], mask, [hue_bins], [0, 180]).ravel() / count
+        channel_percentiles = {}
+        for channel, name in enumerate('BGR'):
+            hist = cv2.calcHist([image], [channel], mask, [256], [0, 256]).ravel()
+            channel_percentiles[name] = _hist_percentiles(hist, count, percentiles)
+        results.append({
+            'count': count,
+            'BGR': (b, g, r),
+            'BR': _ratio(b, r),
+            'BG': _ratio(b, g),
+            'Lab_b': lab_b,
+            'hue_hist': [float(v) for v in hue_hist],
+            'percentiles': channel_percentiles,
+        })
+    return results
+
+
+def masked_stats(image, mask, percentiles=(10, 50, 90), hue_bins=18):
+    return masked_stats_batch(image, (mask,), percentiles, hue_bins)[0]
+
+
+def eye_features(image, gb_final_mask):
+    # What is stored as sample_data['eyes'][side]
+    stats = masked_stats(image, gb_final_mask)
+    if stats is None:
+        return None
+    return {
+        'BR': stats['BR'],
+        'BG': stats['BG'],
+        'BGR': [round(v, 3) for v in stats['BGR']],
+        'Lab_b': round(stats['Lab_b'], 3),
+        'hue_hist': [round(v, 4) for v in stats['hue_hist']],
+        'percentiles': stats['percentiles'],
+    }
+
+
+def calc_yellow(gb_mask, image):
+    if gb_mask is not None:
+        stats = masked_stats(image, gb_mask)
+        if stats is None:
+            return None
+        return (np.array(stats['BGR']), stats['BR'], stats['BG'])
+    return None
+
+
+def analyze_eye(eye_img, rect=None, ite=5, levels=0):
+    # The AcquireWindow steps without the user: filter, segment and measure.
+    # levels > 0 segments coarse to fine (grab_cut_pyramid)
+    im_filtered = filter_eye(eye_img)
+    if rect is None:
+        rect = default_rect(im_filtered)
+    if levels > 0:
+        gb_mask, _, _ = grab_cut_pyramid(im_filtered, rect, levels=levels, ite=ite)
+    else:
+        gb_mask, _, _ = grab_cut_rect(im_filtered, rect, ite=ite)
+    return eye_features(im_filtered, final_mask(gb_mask))
+
+
+def analyze_sample(sample_img_bgr, margin=0.1, ite=5, levels=0):
+    # Both eyes of a full capture: {'R': {...}, 'L': {...}}
+    img_croped = sample_slice(sample_img_bgr)
+    eyes = {}
+    for side, eye in (('R', right_eye(img_croped)), ('L', left_eye(img_croped))):
+        eyes[side] = analyze_eye(eye, rect=default_rect(eye, margin), ite=ite, levels=levels)
+    return eyes
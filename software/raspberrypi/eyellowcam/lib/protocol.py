@@ -0,0 +1,158 @@
+# MIT License
+
+# Copyright (c) 2021 Anderson R. Livramento
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import asyncio
+import base64
+import json
+import os
+import socket
+import struct
+
+# Binary frame layout (all integers little endian):
+#
+#   header     magic(4) version(1) flags(1) parts count(2) metadata length(4)
+#   parts      one uint32 length for each binary part
+#   metadata   UTF-8 JSON document
+#   parts data raw bytes of every binary part, in order
+#
+# The metadata 'attachments' list names each binary part. A part can be any
+# bytes-like object (sent from a memoryview) or an open binary file, which is
+# sent from its current position with socket.sendfile, without copying it
+# into Python.
+MAGIC = b'\x89EYL'
+VERSION = 1
+HEADER = struct.Struct('<4sBBHI')
+PART_LENGTH = struct.Struct('<I')
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def recv_into_exact(sock, buffer):
+    view = memoryview(buffer)
+    while len(view):
+        read = sock.recv_into(view)
+        if not read:
+            raise ProtocolError('Connection closed while reading frame')
+        view = view[read:]
+    return buffer
+
+
+def recv_exact(sock, size):
+    return recv_into_exact(sock, bytearray(size))
+
+
+def pack_frame_head(meta, part_sizes, flags=0):
+    meta_bytes = json.dumps(meta, ensure_ascii=False).encode('utf-8')
+    head = bytearray(HEADER.pack(MAGIC, VERSION, flags, len(part_sizes), len(meta_bytes)))
+    for size in part_sizes:
+        head += PART_LENGTH.pack(size)
+    head += meta_bytes
+    return head
+
+
+def part_size(content):
+    if hasattr(content, 'fileno'):
+        return os.fstat(content.fileno()).st_size - content.tell()
+    return memoryview(content).nbytes
+
+
+def send_frame(sock, meta, attachments=()):
+    if attachments:
+        meta = dict(meta, attachments=[name for name, _ in attachments])
+    parts = [content for _, content in attachments]
+    sizes = [part_size(content) for content in parts]
+    sock.sendall(pack_frame_head(meta, sizes))
+    for content, size in zip(parts, sizes):
+        if hasattr(content, 'fileno'):
+            sock.sendfile(content, content.tell(), size)
+        else:
+            sock.sendall(memoryview(content))
+
+
+def unpack_frame_head(head):
+    # (parts count, metadata length) of a HEADER
+    magic, version, flags, parts_count, meta_len = HEADER.unpack(head)
+    if magic != MAGIC:
+        raise ProtocolError('Invalid frame magic: {!r}'.format(magic))
+    if version > VERSION:
+        raise ProtocolError('Unsupported frame version: {}'.format(version))
+    return (parts_count, meta_len)
+
+
+def read_frame(sock):
+    parts_count, meta_len = unpack_frame_head(recv_exact(sock, HEADER.size))
+    sizes = recv_exact(sock, PART_LENGTH.size * parts_count)
+    meta = recv_exact(sock, meta_len)
+    parts = [recv_exact(sock, size) for size, in PART_LENGTH.iter_unpack(sizes)]
+    return (meta, parts)
+
+
+def encode_legacy(response, attachments=(), terminator='\r\n\r\n'):
+    # Reply to a legacy client: base64 JSON, every attachment as a base64
+    # field of it, then the terminator
+    response = dict(response)
+    if attachments:
+        response['attachments'] = [name for name, _ in attachments]
+    for name, content in attachments:
+        if hasattr(content, 'read'):
+            content = content.read()
+        response[name] = base64.b64encode(content).decode('utf-8')
+    data = json.dumps(response, ensure_ascii=False).encode('utf-8')
+    return base64.b64encode(data) + terminator.encode('utf-8')
+
+
+async def read_frame_async(reader, head=b''):
+    # read_frame from an asyncio StreamReader; head: bytes of the header
+    # already read (to tell a frame from a legacy request)
+    try:
+        head += await reader.readexactly(HEADER.size - len(head))
+        parts_count, meta_len = unpack_frame_head(head)
+        sizes = await reader.readexactly(PART_LENGTH.size * parts_count)
+        meta = await reader.readexactly(meta_len)
+        parts = [await reader.readexactly(size) for size, in PART_LENGTH.iter_unpack(sizes)]
+    except asyncio.IncompleteReadError:
+        raise ProtocolError('Connection closed while reading frame')
+    return (meta, parts)
+
+
+async def send_frame_async(writer, meta, attachments=()):
+    # send_frame to an asyncio StreamWriter, files with loop.sendfile
+    if attachments:
+        meta = dict(meta, attachments=[name for name, _ in attachments])
+    parts = [content for _, content in attachments]
+    sizes = [part_size(content) for content in parts]
+    writer.write(pack_frame_head(meta, sizes))
+    for content, size in zip(parts, sizes):
+        if hasattr(content, 'fileno'):
+            await writer.drain()
+            await asyncio.get_event_loop().sendfile(writer.transport, content, content.tell(), size)
+        else:
+            writer.write(memoryview(content))
+    await writer.drain()
+
+
+def is_frame(sock):
+    # Peek the first bytes to tell a binary frame from a legacy base64 request
+    head = sock.recv(len(MAGIC), socket.MSG_PEEK | socket.MSG_WAITALL)
+    return head == MAGIC
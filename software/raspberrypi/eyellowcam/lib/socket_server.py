@@ -20,78 +20,294 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import socket
 import socketserver
 import threading
-import io
+import concurrent.futures
+import collections
 import struct
 import base64
 import datetime
+import json
+import time
+
+from lib import protocol
 
 
 ####################[ Stream Server ]#################################################
 # Camera Streamming, most of code based on
 # https://picamera.readthedocs.io/en/latest/recipes2.html#rapid-capture-and-streaming
 
+FRAME_HEADER = struct.Struct('<L')
+
+
+class FrameBuffer(object):
+    # Reusable frame storage: room for the stream length header followed by
+    # the JPEG, so a whole packet goes out from a single memoryview
+
+    def __init__(self, pool, capacity):
+        self.pool = pool
+        self.data = bytearray(FRAME_HEADER.size + capacity)
+        self.size = 0
+        self.refs = 0
+        # time.time() of the frame first buffer
+        self.timestamp = 0.0
+
+    def append(self, buffer):
+        start = FRAME_HEADER.size + self.size
+        end = start + len(buffer)
+        if end > len(self.data):
+            # Bigger than every frame so far, grows once
+            self.data.extend(bytes(end - len(self.data)))
+        self.data[start:end] = buffer
+        self.size += len(buffer)
+
+    def seal(self):
+        FRAME_HEADER.pack_into(self.data, 0, self.size)
+
+    def packet(self):
+        return memoryview(self.data)[:FRAME_HEADER.size + self.size]
+
+    def payload(self):
+        return memoryview(self.data)[FRAME_HEADER.size:FRAME_HEADER.size + self.size]
+
+    def acquire(self):
+        self.pool.acquire(self)
+
+    def release(self):
+        self.pool.release(self)
+
+
+class FramePool(object):
+    # Frame buffers allocated once and recycled when nobody holds them
+
+    def __init__(self, count, capacity):
+        self.lock = threading.Lock()
+        self.free = [FrameBuffer(self, capacity) for _ in range(count)]
+
+    def get(self):
+        with self.lock:
+            if not self.free:
+                return None
+            frame = self.free.pop()
+            frame.size = 0
+            frame.refs = 1
+            return frame
+
+    def acquire(self, frame):
+        with self.lock:
+            frame.refs += 1
+
+    def release(self, frame):
+        with self.lock:
+            frame.refs -= 1
+            if frame.refs == 0:
+                self.free.append(frame)
+
+
+class FrameBroadcaster(object):
+    # The encoder publishes every frame once; the last frames are kept in a
+    # ring and each subscriber reads them at its own pace through a cursor
+    # (the sequence number of the last frame it got)
+
+    def __init__(self, size=30, frame_capacity=128 * 1024, max_subscribers=16):
+        self.size = size
+        # Ring frames, one being sent by each subscriber and one being written
+        self.pool = FramePool(size + max_subscribers + 1, frame_capacity)
+        self.frames = collections.deque()
+        self.seq = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        # Called from the encoder thread after each publish and on close, for
+        # subscribers that can't block on cond (the asyncio server)
+        self.listeners = []
+
+    def publish(self, frame):
+        # Takes over the caller reference to frame
+        with self.cond:
+            self.seq += 1
+            if len(self.frames) == self.size:
+                self.frames.popleft()[1].release()
+            self.frames.append((self.seq, frame))
+            self.cond.notify_all()
+        for listener in self.listeners:
+            listener()
+
+    def next_frame(self, cursor, timeout=None, max_queue=None):
+        # (seq, frame) following cursor, or the oldest one kept when the
+        # subscriber fell behind the ring. With max_queue, no more than
+        # max_queue frames wait for the subscriber: older ones are skipped
+        # (max_queue=1 always gives the newest frame). None on timeout or
+        # when closed. The frame must be released after use.
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.seq > cursor or self.closed, timeout):
+                return None
+            if self.closed:
+                return None
+            oldest = self.frames[0][0]
+            if max_queue:
+                oldest = max(oldest, self.seq - max_queue + 1)
+            seq, frame = self.frames[max(cursor + 1, oldest) - self.frames[0][0]]
+            frame.acquire()
+            return (seq, frame)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            while self.frames:
+                self.frames.popleft()[1].release()
+            self.cond.notify_all()
+        for listener in self.listeners:
+            listener()
+
+
+class FrameHistory(object):
+    # The last frames of a recording, for captures of a past moment: the
+    # frame closest to a given time.time()
+
+    def __init__(self, size=30, frame_capacity=512 * 1024, max_held=4):
+        self.size = size
+        # Kept frames, one being written and max_held being copied by captures
+        self.pool = FramePool(size + max_held + 1, frame_capacity)
+        self.frames = collections.deque()
+        self.lock = threading.Lock()
+
+    def publish(self, frame):
+        # Takes over the caller reference to frame
+        with self.lock:
+            if len(self.frames) == self.size:
+                self.frames.popleft().release()
+            self.frames.append(frame)
+
+    def nearest(self, timestamp, max_distance=None):
+        # The frame closest to timestamp, None if the closest is further than
+        # max_distance seconds. The frame must be released after use.
+        with self.lock:
+            if not self.frames:
+                return None
+            frame = min(self.frames, key=lambda f: abs(f.timestamp - timestamp))
+            if max_distance is not None and abs(frame.timestamp - timestamp) > max_distance:
+                return None
+            frame.acquire()
+            return frame
+
+    def close(self):
+        with self.lock:
+            while self.frames:
+                self.frames.popleft().release()
+
+
 class SplitFrames(object):
+    # Runs on the encoder callback: only copies the buffer into a pooled
+    # frame, the network is left to the stream connections. Frames go to
+    # broadcaster.publish, a FrameBroadcaster or a FrameHistory. clock()
+    # gives the time a new frame was captured, time.time() (its arrival)
+    # when None.
 
-    def __init__(self, conn):
-        self.conn = conn
-        self.stream = io.BytesIO()
+    def __init__(self, broadcaster, clock=None):
+        self.broadcaster = broadcaster
+        self.clock = clock or time.time
+        self.frame = broadcaster.pool.get()
+        self.dropped = 0
 
     def write(self, buffer):
         if buffer.startswith(b'\xff\xd8'):
             # Start of new frame;
-            size = self.stream.tell()
-            if size > 0:
-                self.conn.write(struct.pack('<L', size))
-                self.conn.flush()
-                self.stream.seek(0)
-                self.conn.write(self.stream.read(size))
-                self.stream.seek(0)
-        self.stream.write(buffer)
+            if self.frame is not None and self.frame.size > 0:
+                self.frame.seal()
+                self.broadcaster.publish(self.frame)
+                self.frame = None
+            if self.frame is None:
+                self.frame = self.broadcaster.pool.get()
+                if self.frame is None:
+                    # Every buffer is held, skip this frame
+                    self.dropped += 1
+                else:
+                    self.frame.timestamp = self.clock()
+        if self.frame is not None:
+            self.frame.append(buffer)
 
 
-class StreamServer(threading.Thread):
+class StreamRecorder(object):
+    # The camera encoders: the MJPEG preview goes to a FrameBroadcaster and,
+    # with history_frames > 0, history_resolution frames from another
+    # splitter port go to a FrameHistory (zero shutter lag captures); the
+    # camera then runs at that resolution and the preview is resized to
+    # 640 pixels wide, keeping its aspect ratio (640x360 for full HD).
 
-    def __init__(self, camera, port=2323):
-        super(StreamServer, self).__init__()
+    def __init__(self, camera, history_frames=0, history_resolution=(1920, 1080), history_port=2):
         self.camera = camera
-        self.camera.resolution = 'VGA'
+        self.preview_resize = None
+        self.history = None
+        self.history_port = history_port
+        if history_frames:
+            self.camera.resolution = history_resolution
+            width, height = history_resolution
+            self.preview_resize = (640, 640 * height // width)
+            self.history = FrameHistory(size=history_frames)
+        else:
+            self.camera.resolution = 'VGA'
         self.camera.framerate = 30
-        self.port = port
-        self.alive = threading.Event()
-        self.alive.set()
-
-    def run(self):
-        server = socket.socket()
-        server.bind(('0.0.0.0', self.port))
-        server.listen(0)
-        while self.alive.is_set():
-            print('\n[StreamServer] Waiting for connection...')
-            conn, addr = server.accept()
-            stream = conn.makefile('wb')
-            output = SplitFrames(stream)
-            print('\n[StreamServer] Connected to: ', addr)
-            try:
-                self.camera.start_recording(output, format='mjpeg')
-                while self.alive.is_set():
-                    try:
-                        self.camera.wait_recording()
-                    except Exception:
-                        break
-                self.camera.stop_recording()
-                stream.close()
-            except Exception as e:
-                print('\n[StreamServer] ERROR: ', e)
-            finally:
-                conn.close()
-                print('\n[StreamServer] Connection closed.')
-        server.close()
-
-####################[ Command Server ]#############################################
+        self.broadcaster = FrameBroadcaster()
+
+    def frame_clock(self, splitter_port):
+        # Wall time the frame being written on splitter_port was captured:
+        # its presentation timestamp (camera clock, microseconds), moved back
+        # from now by its age, so the encoder latency doesn't count. picamera
+        # only exposes the frame of a given port through _encoders.
+        def clock():
+            now = time.time()
+            encoder = self.camera._encoders.get(splitter_port)
+            frame = encoder.frame if encoder is not None else None
+            if frame is None or frame.timestamp is None:
+                return now
+            return now - (self.camera.timestamp - frame.timestamp) / 1000000
+
+        return clock
+
+    def start(self):
+        # The encoder runs once for every client
+        self.camera.start_recording(
+            SplitFrames(self.broadcaster, self.frame_clock(1)),
+            format='mjpeg',
+            resize=self.preview_resize
+        )
+        if self.history is not None:
+            self.camera.start_recording(
+                SplitFrames(self.history, self.frame_clock(self.history_port)),
+                format='mjpeg',
+                splitter_port=self.history_port
+            )
+
+    def check(self):
+        # Raises encoder errors
+        self.camera.wait_recording(0)
+
+    def stop(self):
+        self.broadcaster.close()
+        if self.history is not None:
+            self.camera.stop_recording(splitter_port=self.history_port)
+            self.history.close()
+        self.camera.stop_recording()
+
+
+class CommandServer(socketserver.ThreadingTCPServer):
+    # One thread per connection, so a slow capture doesn't hold other clients
+    allow_reuse_address = True
+    daemon_threads = True
+
+
 class BaseCommandProtocolHandler(socketserver.BaseRequestHandler):
     terminator = '\r\n\r\n'
+    # Set to False to refuse the old base64 '\r\n\r\n' terminated requests
+    allow_legacy = True
+    # Command run when the request has no 'command' (legacy clients)
+    default_command = None
+    # Requests of one keep-alive connection running at the same time
+    max_workers = 4
+
+    def setup(self):
+        self.binary = False
+        self.send_lock = threading.Lock()
 
     def readall(self):
         data_in = ''
@@ -111,10 +327,71 @@ class BaseCommandProtocolHandler(socketserver.BaseRequestHandler):
         data_b64 = base64.b64encode(bytes(data, 'utf-8')) + bytes(self.terminator, 'utf-8')
         self.request.sendall(data_b64)
 
+    def send_response(self, response, attachments=()):
+        # attachments: sequence of (name, bytes-like or binary file) pairs
+        if self.binary:
+            protocol.send_frame(self.request, response, attachments)
+        else:
+            self.request.sendall(protocol.encode_legacy(response, attachments, self.terminator))
+
     def handle(self):
-        data_b64 = self.readall()
-        data = base64.b64decode(data_b64)
-        self.process_data(data.decode('utf-8'))
-    
+        self.binary = protocol.is_frame(self.request)
+        if not self.binary:
+            if self.allow_legacy:
+                data_b64 = self.readall()
+                try:
+                    data = base64.b64decode(data_b64)
+                except ValueError as e:
+                    self.send_response({'error': str(e)})
+                    return
+                self.process_data(data)
+            else:
+                print('[CommandServer] Legacy request refused.')
+            return
+        # Keep-alive: the connection carries many requests, each one answered
+        # as soon as it is done, tagged with its request_id
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as workers:
+            while True:
+                try:
+                    meta, _ = protocol.read_frame(self.request)
+                except (OSError, protocol.ProtocolError):
+                    # Connection closed
+                    break
+                try:
+                    control = json.loads(meta)
+                except ValueError:
+                    # Answered with the error by process_data
+                    control = None
+                if isinstance(control, dict) and control.get('connect') == 'close':
+                    break
+                workers.submit(self.process_data, meta)
+
     def process_data(self, data):
-        raise NotImplementedError
+        request_id = None
+        attachments = []
+        try:
+            request = json.loads(data)
+            if not isinstance(request, dict):
+                raise ValueError('Request must be a JSON object')
+            request_id = request.pop('request_id', None)
+            response, attachments = self.process_request(request)
+        except Exception as e:
+            response = {'error': str(e)}
+            print('Error:\n\n', e)
+        if request_id is not None:
+            response['request_id'] = request_id
+        try:
+            with self.send_lock:
+                self.send_response(response, attachments)
+        finally:
+            for _, content in attachments:
+                if hasattr(content, 'close'):
+                    content.close()
+
+    def process_request(self, request):
+        command = request.pop('command', self.default_command)
+        handler = getattr(self, 'cmd_{}'.format(command), None)
+        if handler is None:
+            return ({'error': 'Unknown command: {}'.format(command)}, [])
+        # Command handlers return (response, attachments)
+        return handler(request)
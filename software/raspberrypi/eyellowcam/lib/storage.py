@@ -0,0 +1,61 @@
+# MIT License
+
+# Copyright (c) 2021 Anderson R. Livramento
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import queue
+import threading
+
+
+class DCIMWriter(threading.Thread):
+    # Persists captured images in background, off the capture critical path
+
+    def __init__(self, max_pending=8):
+        super(DCIMWriter, self).__init__()
+        # Bounded: save() blocks when the SD card can't keep up
+        self.pending = queue.Queue(maxsize=max_pending)
+
+    def save(self, path, content):
+        self.pending.put((path, content))
+
+    def run(self):
+        while True:
+            item = self.pending.get()
+            try:
+                if item is None:
+                    break
+                path, content = item
+                with open(path, 'wb') as fp:
+                    fp.write(content)
+                    fp.flush()
+                    os.fsync(fp.fileno())
+            except Exception as e:
+                print('\n[DCIMWriter] ERROR: ', e)
+            finally:
+                self.pending.task_done()
+
+    def flush(self):
+        # Wait every queued image to be on disk
+        self.pending.join()
+
+    def stop(self):
+        self.pending.put(None)
+        self.join()
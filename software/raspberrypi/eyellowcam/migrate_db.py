@@ -0,0 +1,40 @@
+# MIT License
+
+# Copyright (c) 2021 Anderson R. Livramento
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import sys
+
+from lib import model
+
+
+# Converts an existing samples database to the latest schema, in place:
+#   python3 migrate_db.py [/path/to/dcim]
+if __name__ == '__main__':
+    dbpath = sys.argv[1] if len(sys.argv) > 1 else model.DATABASE_PATH
+    if not os.path.exists('/'.join((dbpath, 'eyellow_samples.db'))):
+        print('No database found in', dbpath)
+        sys.exit(1)
+    db = model.DBModel(dbpath)
+    print('Migrating {} from schema version {}...'.format(db.db_file, db.schema_version()))
+    db.create_database()
+    print('Done, schema version {}.'.format(db.schema_version()))
+    db.close()
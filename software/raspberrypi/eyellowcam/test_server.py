@@ -20,47 +20,56 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import socketserver
-import base64
+import os
+import time
 import json
 
 from lib import model
-from lib.socket_server import BaseCommandProtocolHandler
+from lib.socket_server import (
+    CommandServer,
+    BaseCommandProtocolHandler,
+)
+
+db = None
 
 
 class CommandHandler(BaseCommandProtocolHandler):
-        
-    def process_data(self, data):
+    default_command = 'capture'
+
+    def cmd_capture(self, request):
         response = {
             'error': ''
         }
+        attachments = []
         try:
-            data_json = json.loads(data)
-            if data_json.get('connect') == 'close' and not self.connected:
-                print('Closing connection...')
-                self.close()
-            else:
-                print('Received:', data)
-                db = model.DBModel('.')
-                sample_id = db.insert_sample(data)
-                sample_file = 'eye-sample-{}.jpg'.format(sample_id)
-                print('Capturing Image to file ', sample_file)
-                # camera.capture(sample_file, splitter_port=3, resize=(3280, 1080))
-                response['sample_id'] = sample_id
-                response['sample_file'] = sample_file
-                db.close()
+            data = json.dumps(request, ensure_ascii=False)
+            print('Received:', data)
+            sample_id = db.insert_sample(data)
+            sample_file = 'eye-sample-{}.jpg'.format(sample_id)
+            print('Capturing Image to file ', sample_file)
+            # camera.capture(sample_file, splitter_port=3, resize=(3280, 1080))
+            response['sample_id'] = sample_id
+            response['sample_file'] = sample_file
+            # Send a previously captured image, if there is one, to exercise the attachments
+            if os.path.exists(sample_file):
+                # Sent with sendfile, straight from the file
+                attachments.append(('sample_file_content', open(sample_file, 'rb')))
         except Exception as e:
             response['error'] = str(e)
             print('Error:\n\n', e)
-        self.send_data(json.dumps(response, ensure_ascii=False))
+        return (response, attachments)
+
+    def cmd_status(self, request):
+        return ({'error': '', 'server_time': time.time()}, [])
 
 
 if __name__ == '__main__':
     print('Creating Database...')
     db = model.DBModel('.')
     db.create_database()
-    db.close()
     print('Start Listening on localhost:8080...')
-    with socketserver.TCPServer(('localhost', 8080), CommandHandler) as server:
-        server.serve_forever()
-    
\ No newline at end of file
+    try:
+        with CommandServer(('localhost', 8080), CommandHandler) as server:
+            server.serve_forever()
+    finally:
+        db.close()